@@ -1,13 +1,56 @@
-
-import os
 import io
-import time
-from typing import Optional, Dict, Any, Tuple
-
+import os
+import copy
+import contextvars
+import hashlib
+import importlib.machinery
+import tempfile
+import threading
+import uuid
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Optional, Dict, Any, Tuple, NamedTuple, List, Hashable
+
+import numpy as np
 import pandas as pd
-import requests
 import streamlit as st
-from bs4 import BeautifulSoup
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
+
+from ingest import ColumnStore, CsvDialect, convert_to_arrow, load_csv, prune_files, sniff_source
+from review import MATCH, NO_MATCH, REVIEW_JOURNAL_PATH, UNREVIEWED, MatchState, ReviewJournal
+from features import (
+    FEATURE_STORE_PATH,
+    ExtractionStats,
+    FeatureStore,
+    content_hash as image_content_hash,
+    extract_urls,
+    feature_record,
+    pair_scores,
+)
+from similarity import RowScores, similarity_score
+from matching import MIN_RELIABLE_SCORE, TOP_K, RepairSuggestions, match_catalogs
+from resolver import (
+    DEFAULT_HOST_RATES,
+    CACHE_DIR,
+    IMAGE_STORE_PATH,
+    MAX_WORKERS,
+    DownloadPlan,
+    HostRateLimiter,
+    ImageUrlStore,
+    build_download_plan,
+    build_session,
+    canonical_amazon_url,
+    fetch_image_bytes,
+    fetch_og_image,
+    get_proxy_config,
+    lookup_image_url,
+    measure_throttle,
+)
+
+
+# Streamlit esegue lo script come modulo __main__ senza __spec__: i processi del pool di
+# features.py (spawn/forkserver) lo rieseguirebbero per intero all'avvio. Con
+# __spec__.name == "__main__" multiprocessing non reimporta il modulo principale nei figli.
+__spec__ = importlib.machinery.ModuleSpec("__main__", None)
 
 
 # -----------------------------
@@ -18,117 +61,83 @@ st.title("CSV Matcher: Amazon vs Grossista")
 
 
 # -----------------------------
-# Proxy (IPRoyal) via ENV / Secrets
+# Rete e cache condivise (vedi resolver.py)
 # -----------------------------
-def get_proxy_config() -> Optional[Dict[str, str]]:
-    """
-    Legge proxy da variabili ambiente.
-    Esempio:
-      PROXY_HOST=...
-      PROXY_PORT=...
-      PROXY_USER=...
-      PROXY_PASS=...
-    Restituisce dict compatibile con requests: {"http": "...", "https": "..."}
-    """
-    host = os.getenv("PROXY_HOST", "").strip()
-    port = os.getenv("PROXY_PORT", "").strip()
-    user = os.getenv("PROXY_USER", "").strip()
-    password = os.getenv("PROXY_PASS", "").strip()
+SESSION = build_session()
+PROXIES = get_proxy_config()
 
-    if not host or not port:
-        return None
 
-    if user and password:
-        proxy_url = f"http://{user}:{password}@{host}:{port}"
-    else:
-        proxy_url = f"http://{host}:{port}"
+@st.cache_resource
+def get_rate_limiter() -> HostRateLimiter:
+    # condiviso tra sessioni e thread: il budget per host è del processo, non del singolo utente
+    return HostRateLimiter(DEFAULT_HOST_RATES)
 
-    return {"http": proxy_url, "https": proxy_url}
 
+@st.cache_resource
+def get_image_store() -> ImageUrlStore:
+    return ImageUrlStore(IMAGE_STORE_PATH)
 
-def get_timeout() -> Tuple[float, float]:
-    # (connect timeout, read timeout)
-    return (5.0, 12.0)
 
+@st.cache_resource
+def get_feature_store() -> FeatureStore:
+    return FeatureStore(FEATURE_STORE_PATH)
 
-def build_session() -> requests.Session:
-    s = requests.Session()
-    # User-Agent “normale” (aiuta a ricevere HTML standard)
-    s.headers.update(
-        {
-            "User-Agent": (
-                "Mozilla/5.0 (Windows NT 10.0; Win64; x64) "
-                "AppleWebKit/537.36 (KHTML, like Gecko) "
-                "Chrome/123.0.0.0 Safari/537.36"
-            ),
-            "Accept-Language": "it-IT,it;q=0.9,en-US;q=0.8,en;q=0.7",
-        }
-    )
-    return s
 
+@st.cache_resource
+def get_review_journal() -> ReviewJournal:
+    return ReviewJournal(REVIEW_JOURNAL_PATH)
 
-SESSION = build_session()
-PROXIES = get_proxy_config()
+
+RATE_LIMITER = get_rate_limiter()
+IMAGE_STORE = get_image_store()
+REVIEW_JOURNAL = get_review_journal()
+FEATURE_STORE = get_feature_store()
 
 
 # -----------------------------
-# Cache: HTML e immagini
+# Cache: URL immagine Amazon e immagini
 # -----------------------------
-@st.cache_data(show_spinner=False, ttl=60 * 60)
-def fetch_html(url: str) -> Optional[str]:
-    try:
-        r = SESSION.get(url, proxies=PROXIES, timeout=get_timeout(), allow_redirects=True)
-        if r.status_code >= 400:
-            return None
-        # Amazon può rispondere gzip/charset variabile → requests gestisce
-        return r.text
-    except requests.RequestException:
-        return None
+@st.cache_data(show_spinner=False, ttl=24 * 60 * 60)
+def resolve_og_image(url: str) -> Tuple[str, Optional[str]]:
+    # in cache resta solo (stato, url immagine), mai l'HTML; FetchError non viene memorizzato
+    return fetch_og_image(url, SESSION, PROXIES, RATE_LIMITER)
 
 
 @st.cache_data(show_spinner=False, ttl=24 * 60 * 60)
-def extract_og_image(html: str) -> Optional[str]:
-    try:
-        soup = BeautifulSoup(html, "html.parser")
-        tag = soup.find("meta", property="og:image")
-        if tag and tag.get("content"):
-            return tag["content"].strip()
-
-        # fallback twitter:image
-        tag = soup.find("meta", attrs={"name": "twitter:image"})
-        if tag and tag.get("content"):
-            return tag["content"].strip()
+def download_image_bytes(url: str) -> Optional[bytes]:
+    return fetch_image_bytes(url, SESSION, PROXIES, RATE_LIMITER)
 
-        return None
-    except Exception:
-        return None
 
+def page_hashes(images: Dict[str, bytes], pool: ThreadPoolExecutor) -> Dict[str, Optional[np.ndarray]]:
+    """
+    Hash (bool, 192 bit) delle immagini già scaricate per la pagina visibile, con poche letture
+    dello store per tutta la pagina: le feature si calcolano (nel pool) solo per gli URL senza
+    mappa o mappati su un contenuto senza feature (es. estrazione interrotta), poi si salvano
+    in un solo blocco.
+    """
+    urls = list(images)
+    shas = FEATURE_STORE.url_shas(urls)
+    known = FEATURE_STORE.known(sorted(set(shas.values())))
+    missing = {url: image_content_hash(images[url]) for url in urls if shas.get(url) not in known}
+    if missing:
+        stored = FEATURE_STORE.known(sorted(set(missing.values())))
+        todo = {sha: images[url] for url, sha in missing.items() if sha not in stored}
+        FEATURE_STORE.put_many(pool.map(feature_record, todo.keys(), todo.values()))
+        FEATURE_STORE.put_urls(missing.items())
+        shas.update(missing)
+    valid, hashes, _ = FEATURE_STORE.gather([shas[url] for url in urls])
+    return {url: np.unpackbits(h).astype(bool) if ok else None for url, ok, h in zip(urls, valid, hashes)}
 
-@st.cache_data(show_spinner=False, ttl=24 * 60 * 60)
-def download_image_bytes(url: str) -> Optional[bytes]:
-    try:
-        r = SESSION.get(url, proxies=PROXIES, timeout=get_timeout(), stream=True)
-        if r.status_code >= 400:
-            return None
-
-        # limita dimensione per evitare bombe di memoria
-        max_bytes = 3_500_000  # ~3.5MB
-        data = bytearray()
-        for chunk in r.iter_content(chunk_size=64 * 1024):
-            if not chunk:
-                break
-            data.extend(chunk)
-            if len(data) > max_bytes:
-                break
-        return bytes(data)
-    except requests.RequestException:
-        return None
+
+def lookup_amazon_image_url(key: str) -> Optional[str]:
+    return lookup_image_url(key, IMAGE_STORE, resolve_og_image)
 
 
 def get_amazon_image_url(row: pd.Series, amazon_url_col: str, amazon_img_col: Optional[str]) -> Optional[str]:
     """
     Se amazon_img_col è presente e valorizzata: usa quella (consigliato).
-    Altrimenti prova a estrarre og:image dall'HTML dell'amazon_url.
+    Altrimenti cerca nella cache persistente e, se manca o è scaduta,
+    prova a estrarre og:image dall'HTML dell'amazon_url.
     """
     if amazon_img_col and amazon_img_col in row and pd.notna(row[amazon_img_col]) and str(row[amazon_img_col]).strip():
         return str(row[amazon_img_col]).strip()
@@ -137,26 +146,357 @@ def get_amazon_image_url(row: pd.Series, amazon_url_col: str, amazon_img_col: Op
     if not url:
         return None
 
-    html = fetch_html(url)
-    if not html:
-        return None
+    # stesso prodotto = stessa chiave (ASIN + marketplace), qualunque sia la forma dell'URL nel CSV
+    return lookup_amazon_image_url(canonical_amazon_url(url))
+
+
+@st.cache_resource(show_spinner=False, max_entries=4)
+def plan_downloads(
+    file_key: str,
+    _df: pd.DataFrame,
+    amazon_url_col: str,
+    amazon_img_col: Optional[str],
+    grossista_img_col: str,
+) -> DownloadPlan:
+    # file_key identifica il contenuto di _df (il DataFrame non viene hashato)
+    return build_download_plan(_df, amazon_url_col, amazon_img_col, grossista_img_col, IMAGE_STORE)
 
-    return extract_og_image(html)
+
+@st.cache_resource(max_entries=4)
+def get_row_scores(plan_key: Tuple, n_rows: int) -> RowScores:
+    # plan_key: file + colonne immagine; i punteggi sono condivisi da tutte le sessioni
+    return RowScores(n_rows)
+
+
+@st.cache_resource(max_entries=4)
+def get_repair_suggestions(plan_key: Tuple, n_rows: int) -> RepairSuggestions:
+    # come get_row_scores: la ricerca sull'intero file si fa una volta per tutte le sessioni
+    return RepairSuggestions(n_rows)
 
 
 # -----------------------------
-# Stato: dizionario match
+# Risoluzione immagini della pagina (in parallelo)
 # -----------------------------
-if "match_map" not in st.session_state:
-    st.session_state.match_map = {}  # type: ignore
+def _attach_script_ctx(ctx) -> None:
+    # st.cache_data legge/scrive la cache solo nei thread con uno ScriptRunContext.
+    # Copia: le funzioni cached marcano il contesto (disallow_cached_widget_usage) e
+    # il contesto originale resta in uso ai rerun successivi nel thread dello script.
+    add_script_run_ctx(threading.current_thread(), copy.copy(ctx) if ctx else None)
+
+
+class RowImages(NamedTuple):
+    amazon_url: Optional[str]
+    amazon_bytes: Optional[bytes]
+    gross_url: Optional[str]
+    gross_bytes: Optional[bytes]
+    score: Optional[int] = None  # similarità visiva 0–100, None se manca un'immagine
+    # abbinamenti alternativi: (riga del grossista, similarità, byte dell'immagine)
+    suggestions: Tuple[Tuple[int, float, Optional[bytes]], ...] = ()
+
+
+def resolve_amazon_image(key: str) -> Tuple[Optional[str], Optional[bytes]]:
+    # HTML → og:image → download sono dipendenti: restano in sequenza nello stesso worker
+    amazon_img_url = lookup_amazon_image_url(key)
+    if not amazon_img_url:
+        return None, None
+    return amazon_img_url, download_image_bytes(amazon_img_url)
+
+
+def unique_tasks(plan_rows: pd.DataFrame) -> Tuple[List[str], List[str]]:
+    """Chiavi Amazon e URL immagine distinti di un blocco di righe del piano, in ordine di riga."""
+    amazon_keys = plan_rows["amazon_key"].dropna().unique().tolist()
+    image_urls = pd.concat([plan_rows["amazon_image"], plan_rows["gross_image"]]).dropna().unique().tolist()
+    return amazon_keys, image_urls
+
+
+def resolve_page_images(
+    page_rows: pd.DataFrame,
+    max_workers: int,
+    suggested: Optional[Dict[int, List[Tuple[int, float, str]]]] = None,
+) -> Dict[int, RowImages]:
+    """
+    Risolve tutte le immagini della pagina con un pool limitato di thread:
+    un task per ogni chiave Amazon distinta (HTML + og:image + download) e uno per ogni
+    URL immagine distinto (download), poi gli hash percettivi per il punteggio di similarità.
+    suggested: per riga, (riga, similarità, URL) delle immagini grossista alternative da scaricare.
+    Il rendering consuma solo i risultati già pronti. I task girano nel contesto del chiamante,
+    così measure_throttle() vede le loro attese.
+    """
+    amazon_keys, image_urls = unique_tasks(page_rows)
+    suggested = suggested or {}
+    image_urls = list(dict.fromkeys(image_urls + [url for alt in suggested.values() for _, _, url in alt]))
+    ctx = contextvars.copy_context()
+
+    with ThreadPoolExecutor(
+        max_workers=max(1, max_workers),
+        thread_name_prefix="resolve",
+        initializer=_attach_script_ctx,
+        initargs=(get_script_run_ctx(),),
+    ) as pool:
+        amazon_futures = {key: pool.submit(ctx.copy().run, resolve_amazon_image, key) for key in amazon_keys}
+        image_futures = {url: pool.submit(ctx.copy().run, download_image_bytes, url) for url in image_urls}
+
+        results: Dict[int, RowImages] = {}
+        for idx, amazon_key, amazon_image, gross_image in page_rows.itertuples():
+            if pd.notna(amazon_image):
+                amazon_url, amazon_bytes = amazon_image, image_futures[amazon_image].result()
+            elif pd.notna(amazon_key):
+                amazon_url, amazon_bytes = amazon_futures[amazon_key].result()
+            else:
+                amazon_url, amazon_bytes = None, None
+            gross_url = gross_image if pd.notna(gross_image) else None
+            results[int(idx)] = RowImages(
+                amazon_url=amazon_url,
+                amazon_bytes=amazon_bytes,
+                gross_url=gross_url,
+                gross_bytes=image_futures[gross_url].result() if gross_url else None,
+                suggestions=tuple((r, s, image_futures[url].result()) for r, s, url in suggested.get(int(idx), ())),
+            )
+
+        scored = {
+            url: data
+            for row in results.values() if row.amazon_bytes and row.gross_bytes
+            for url, data in ((row.amazon_url, row.amazon_bytes), (row.gross_url, row.gross_bytes))
+        }
+        hashes = page_hashes(scored, pool) if scored else {}
+        for idx, row in results.items():
+            if row.amazon_url in hashes and row.gross_url in hashes:
+                score = similarity_score(hashes[row.amazon_url], hashes[row.gross_url])
+                results[idx] = row._replace(score=score)
+    return results
 
 
-def set_match(row_id: int, value: bool):
-    st.session_state.match_map[row_id] = value  # type: ignore
+def score_file(
+    plan: DownloadPlan, row_scores: RowScores, suggestions: RepairSuggestions, max_workers: int, progress
+) -> ExtractionStats:
+    """
+    Punteggio di tutte le righe del file: URL immagine Amazon dalla cache persistente, feature
+    delle immagini non ancora note calcolate nel pool di processi (features.extract_urls),
+    poi punteggi per tutte le righe in un solo passaggio vettoriale sullo store.
+    Con le stesse feature, per ogni immagine Amazon le immagini grossista più simili di tutto
+    il file (matching.match_catalogs).
+    """
+    keys = plan.amazon_refs.index.tolist()
+    amazon_urls: Dict[str, Optional[str]] = {}
+    with ThreadPoolExecutor(
+        max_workers=max(1, max_workers),
+        thread_name_prefix="score",
+        initializer=_attach_script_ctx,
+        initargs=(get_script_run_ctx(),),
+    ) as pool:
+        for i in range(0, len(keys), 256):
+            chunk = keys[i:i + 256]
+            amazon_urls.update(zip(chunk, pool.map(lookup_amazon_image_url, chunk)))
+            done = i + len(chunk)
+            progress.progress(done / len(keys), text=f"URL immagine Amazon: {done:,}/{len(keys):,}")
+
+    rows = plan.rows
+    # URL diretto se presente, altrimenti quello risolto dalla pagina Amazon
+    amazon_col = rows["amazon_image"].astype(object).where(
+        rows["amazon_image"].notna(), rows["amazon_key"].map(amazon_urls)
+    )
+    gross_col = rows["gross_image"].astype(object)
+    urls = pd.concat([amazon_col, gross_col]).dropna().unique().tolist()
+
+    def report(done: int, total: int, rate: float) -> None:
+        progress.progress(done / max(total, 1), text=f"Feature immagini: {done:,}/{total:,}  |  {rate:.1f} img/s")
+
+    stats = extract_urls(
+        urls,
+        lambda url: fetch_image_bytes(url, SESSION, PROXIES, RATE_LIMITER),
+        FEATURE_STORE,
+        download_workers=max_workers,
+        progress=report,
+    )
+
+    row_scores.update(rows.index.to_numpy(), pair_scores(FEATURE_STORE, amazon_col, gross_col))
+
+    progress.progress(1.0, text="Ricerca degli abbinamenti alternativi in tutto il file...")
+    valid_a, hashes_a, _ = FEATURE_STORE.gather_urls(amazon_col)
+    valid_g, hashes_g, _ = FEATURE_STORE.gather_urls(gross_col)
+    suggestions.update(*match_catalogs(valid_a, hashes_a, valid_g, hashes_g, TOP_K))
+    return stats
 
 
-def get_match(row_id: int) -> bool:
-    return bool(st.session_state.match_map.get(row_id, False))  # type: ignore
+# -----------------------------
+# Prefetch in background delle pagine successive
+# -----------------------------
+class PagePrefetcher:
+    """
+    Scalda in background le cache (URL og:image, immagini) delle pagine successive
+    a quella visibile. Ogni nuova pianificazione incrementa la "generazione":
+    i task di una generazione vecchia vengono annullati o saltati, così un salto
+    di pagina ri-prioritizza subito il lavoro.
+    """
+
+    def __init__(self, max_workers: int):
+        self.max_workers = max_workers
+        self._pool = ThreadPoolExecutor(max_workers=max(1, max_workers), thread_name_prefix="prefetch")
+        self._lock = threading.Lock()
+        self._generation = 0
+        self._target: Optional[Hashable] = None
+        self._futures: List[Future] = []
+
+    def cancel(self) -> None:
+        with self._lock:
+            self._generation += 1
+            self._target = None
+            for fut in self._futures:
+                fut.cancel()
+            self._futures = []
+
+    def cancel_if_stale(self, target: Hashable) -> None:
+        if target != self._target:
+            self.cancel()
+
+    def schedule(self, target: Hashable, plan_rows: pd.DataFrame) -> None:
+        """Accoda gli elementi distinti di plan_rows (in ordine di pagina) se target è cambiato."""
+        if target == self._target:
+            return  # rerun sulla stessa pagina: il lavoro è già in coda
+        self.cancel()
+        ctx = get_script_run_ctx()
+        amazon_keys, image_urls = unique_tasks(plan_rows)
+        with self._lock:
+            self._target = target
+            gen = self._generation
+            for url in image_urls:
+                self._futures.append(self._pool.submit(self._warm, gen, ctx, download_image_bytes, url))
+            for key in amazon_keys:
+                self._futures.append(self._pool.submit(self._warm, gen, ctx, resolve_amazon_image, key))
+
+    def _warm(self, gen: int, ctx, fn, arg: str) -> None:
+        if gen != self._generation:
+            return  # l'utente è andato altrove
+        _attach_script_ctx(ctx)
+        fn(arg)
+
+    def shutdown(self) -> None:
+        self.cancel()
+        self._pool.shutdown(wait=False)
+
+
+def get_prefetcher(max_workers: int) -> PagePrefetcher:
+    prefetcher: Optional[PagePrefetcher] = st.session_state.get("prefetcher")
+    if prefetcher is None or prefetcher.max_workers != max_workers:
+        if prefetcher is not None:
+            prefetcher.shutdown()
+        prefetcher = PagePrefetcher(max_workers)
+        st.session_state.prefetcher = prefetcher
+    return prefetcher
+
+
+# -----------------------------
+# Stato match (vedi review.py)
+# -----------------------------
+def clear_match_widgets(row_ids=None):
+    # i widget di esito ricordano il proprio valore: vanno azzerati quando lo stato cambia da fuori
+    if row_ids is None:
+        keys = [k for k in st.session_state.keys() if str(k).startswith("match_") and str(k)[6:].isdigit()]
+    else:
+        keys = [f"match_{int(r)}" for r in row_ids]
+    for key in keys:
+        if key in st.session_state:
+            del st.session_state[key]
+
+
+def init_match_state(content_hash: str, n_rows: int, reviewer: str) -> MatchState:
+    """
+    Un array di stati per file, ripristinato dal journal a ogni (nuovo) upload e poi
+    allineato a ogni rerun con le decisioni degli altri revisori.
+    """
+    if st.session_state.get("match_state_file") != content_hash:
+        clear_match_widgets()
+        st.session_state.match_state = MatchState.restore(n_rows, REVIEW_JOURNAL, content_hash, reviewer)
+        st.session_state.match_state_file = content_hash
+        st.session_state.match_state_restored = st.session_state.match_state.reviewed()
+    state: MatchState = st.session_state.match_state
+    state.reviewer = reviewer
+    clear_match_widgets(state.sync())
+    return state
+
+
+def claim_next_page(content_hash: str, page_size: int):
+    """Callback: lease sulla prossima pagina non revisionata e non assegnata ad altri."""
+    state: MatchState = st.session_state.match_state
+    start = REVIEW_JOURNAL.claim(content_hash, state.reviewer, state.states, page_size)
+    if start is None:
+        st.session_state.no_pages_left = True
+    else:
+        st.session_state.page = start // page_size + 1
+
+
+# esiti selezionabili su ogni card
+STATE_LABELS = {UNREVIEWED: "Da vedere", MATCH: "MATCH", NO_MATCH: "No match"}
+
+
+def complete_page(content_hash: str, page_ids: np.ndarray, page_size: int, claim_next: bool):
+    """
+    Callback: pagina revisionata, le righe rimaste da vedere sono no match; poi, se le pagine
+    seguono il file (non triage/riabbinamento), lease sulla prossima pagina.
+    """
+    state: MatchState = st.session_state.match_state
+    clear_match_widgets(state.complete(page_ids))
+    if claim_next:
+        claim_next_page(content_hash, page_size)
+
+
+def set_match(row_id: int, state: int):
+    st.session_state.match_state.set_state(row_id, state)
+
+
+def get_match(row_id: int) -> int:
+    return st.session_state.match_state.get_state(row_id)
+
+
+# -----------------------------
+# Caricamento CSV (una volta per contenuto)
+# -----------------------------
+def file_hash(uploaded, state_key: str = "file_hash") -> str:
+    """
+    SHA-256 del file caricato, calcolato una sola volta per upload (file_id) e non a ogni rerun.
+    state_key: una voce di sessione per uploader.
+    """
+    cached = st.session_state.get(state_key)
+    if cached and cached[0] == uploaded.file_id:
+        return cached[1]
+    digest = hashlib.sha256(uploaded.getbuffer()).hexdigest()
+    st.session_state[state_key] = (uploaded.file_id, digest)
+    return digest
+
+
+@st.cache_resource(max_entries=4)
+def sniff_upload(content_hash: str, _uploaded) -> Tuple[CsvDialect, List[str]]:
+    # solo i primi KB: dialetto e nomi delle colonne senza parsing del file
+    return sniff_source(_uploaded)
+
+
+@st.cache_resource(show_spinner="Lettura export...", max_entries=2)
+def load_warm_csv(content_hash: str, _uploaded) -> Tuple[pd.DataFrame, CsvDialect]:
+    # export da importare in cache: parsing una volta per contenuto, non a ogni rerun
+    return load_csv(_uploaded)
+
+
+# file convertiti (Arrow IPC), uno per contenuto: sopravvivono ai riavvii dell'app.
+# Cache LRU: mtime = ultimo uso; oltre il budget o l'età massima si eliminano i meno recenti
+UPLOAD_DIR = os.path.join(CACHE_DIR, "uploads")
+UPLOAD_CACHE_BYTES = 2 * 1024 ** 3
+UPLOAD_MAX_AGE = 7 * 24 * 60 * 60
+
+
+@st.cache_resource(show_spinner="Conversione CSV...", max_entries=8)
+def open_upload_store(content_hash: str, _uploaded) -> ColumnStore:
+    """
+    Store colonnare del file, condiviso da tutti i rerun e da tutte le sessioni che caricano lo
+    stesso file. La conversione avviene a blocchi e una sola volta per contenuto; poi colonne e
+    righe si leggono dal file mappato in memoria, solo quando servono.
+    """
+    path = os.path.join(UPLOAD_DIR, f"{content_hash}.arrow")
+    if not os.path.exists(path):
+        dialect, columns = sniff_upload(content_hash, _uploaded)
+        convert_to_arrow(_uploaded, dialect, columns, path)
+        # file aperti da altre sessioni: la memory map resta valida anche dopo l'eliminazione
+        prune_files(UPLOAD_DIR, UPLOAD_CACHE_BYTES, UPLOAD_MAX_AGE, keep=[path])
+    return ColumnStore(path)
 
 
 # -----------------------------
@@ -169,20 +509,43 @@ if not uploaded:
     st.info("Carica un CSV per iniziare.")
     st.stop()
 
-# Leggi CSV in modo robusto
+content_hash = file_hash(uploaded)
+csv_dialect, _ = sniff_upload(content_hash, uploaded)
 try:
-    df = pd.read_csv(uploaded)
-except Exception:
-    uploaded.seek(0)
-    df = pd.read_csv(uploaded, sep=";")
-
-df = df.reset_index(drop=True)
-st.caption(f"Righe: {len(df):,}  |  Colonne: {len(df.columns)}")
-
-cols = list(df.columns)
+    csv_store = open_upload_store(content_hash, uploaded)
+except pd.errors.ParserError as e:
+    st.error(f"Il file non è leggibile come CSV: {e}")
+    st.stop()
+if os.path.exists(csv_store.path):
+    os.utime(csv_store.path)  # ultimo uso, per la cache LRU degli upload
+# encoding effettivo della conversione: può differire da quello del campione
+csv_dialect = csv_dialect._replace(
+    encoding=csv_store.encoding or csv_dialect.encoding,
+    replaced=csv_store.replaced,
+    skipped_rows=csv_store.skipped_rows,
+)
+cols = csv_store.column_names
+caption = st.empty()
+if csv_dialect.replaced:
+    st.warning(
+        "Il file contiene byte non validi per ogni encoding provato: sono stati sostituiti con �. "
+        "Controlla il testo delle righe interessate, finisce così anche nell'export."
+    )
+if csv_dialect.skipped_rows:
+    st.warning(
+        f"{csv_dialect.skipped_rows:,} righe con un numero di campi diverso dall'intestazione sono state saltate: "
+        "non compaiono nella revisione né nell'export."
+    )
 
 with st.sidebar:
     st.header("Impostazioni")
+    if "reviewer" not in st.session_state:
+        st.session_state.reviewer = st.query_params.get("reviewer") or f"revisore-{uuid.uuid4().hex[:6]}"
+    # identifica le decisioni e i lease nel journal condiviso
+    reviewer = st.text_input("Revisore", key="reviewer").strip() or "anonimo"
+    # nell'URL: dopo un refresh la sessione nuova ritrova lo stesso revisore (e i suoi lease)
+    if st.query_params.get("reviewer") != reviewer:
+        st.query_params["reviewer"] = reviewer
     amazon_url_col = st.selectbox("Colonna URL Amazon", cols, index=0)
     grossista_img_col = st.selectbox("Colonna URL immagine Grossista", cols, index=0)
 
@@ -200,18 +563,156 @@ with st.sidebar:
         default=[]
     )
 
-    # Rate limit leggero (per non fare troppe richieste a raffica)
-    rate_limit_ms = st.slider("Pausa tra righe (ms) per fetch Amazon", 0, 500, 60)
+    max_workers = st.slider("Download paralleli", 1, MAX_WORKERS, 8)
+    prefetch_pages = st.slider("Pagine da precaricare in background", 0, 5, 2)
+
+    # Rate limit per host: si applica solo alle richieste che vanno davvero in rete
+    st.caption("Richieste al secondo per host (0 = nessun limite)")
+    RATE_LIMITER.configure(
+        {
+            "amazon": st.slider("Pagine Amazon", 0.0, 20.0, DEFAULT_HOST_RATES["amazon"], 0.5),
+            "amazon_img": st.slider("Immagini Amazon", 0.0, 50.0, DEFAULT_HOST_RATES["amazon_img"], 1.0),
+            "grossista": st.slider("Immagini Grossista", 0.0, 50.0, DEFAULT_HOST_RATES["grossista"], 1.0),
+        }
+    )
+
+    with st.expander("Cache immagini Amazon"):
+        st.caption(f"Voci in cache: {IMAGE_STORE.count():,}")
+        dedupe_caption = st.empty()
+        if st.checkbox("Prepara download della cache", key="export_cache"):
+            st.download_button(
+                "Scarica cache (CSV)",
+                data=IMAGE_STORE.export().to_csv(index=False).encode("utf-8"),
+                file_name="amazon_image_cache.csv",
+                mime="text/csv",
+            )
+        warm_file = st.file_uploader("Importa da export precedente", type=["csv"], key="warm_cache")
+        warm_df = None
+        if warm_file:
+            try:
+                warm_df, warm_dialect = load_warm_csv(file_hash(warm_file, "warm_file_hash"), warm_file)
+            except pd.errors.ParserError as e:
+                st.error(f"Export non leggibile come CSV: {e}")
+            else:
+                if warm_dialect.skipped_rows:
+                    st.caption(f"Righe malformate saltate: {warm_dialect.skipped_rows:,}")
+        if warm_df is not None:
+            warm_cols = list(warm_df.columns)
+            warm_url_col = st.selectbox(
+                "Colonna URL Amazon", warm_cols,
+                index=warm_cols.index("url") if "url" in warm_cols else 0, key="warm_url_col",
+            )
+            warm_img_col = st.selectbox(
+                "Colonna URL immagine Amazon", warm_cols,
+                index=warm_cols.index("image_url") if "image_url" in warm_cols else 0, key="warm_img_col",
+            )
+            if st.button("Importa in cache"):
+                n = IMAGE_STORE.warm(warm_df, warm_url_col, warm_img_col)
+                st.success(f"Importate {n:,} voci.")
+
+    with st.expander("Triage automatico"):
+        triage_on = st.toggle("Rivedi solo le coppie incerte", key="triage")
+        low, high = st.slider("Soglie di similarità: no match sotto, MATCH sopra", 0, 100, (60, 90))
+        score_caption = st.empty()
+        run_scoring = st.button("Calcola punteggi per tutto il file")
+        apply_triage = st.button("Applica le soglie alle righe non revisionate")
+
+    with st.expander("Abbinamenti alternativi"):
+        repair_on = st.toggle("Rivedi solo le righe con un abbinamento migliore", key="repair")
+        min_gain = st.slider("Miglioramento minimo (punti di similarità)", 0, 40, 10)
+        shown_suggestions = st.slider("Immagini suggerite per riga", 0, TOP_K, 3)
+        repair_caption = st.empty()
+
+
+# solo le colonne di URL/immagini; i dettagli si leggono per la sola pagina visibile
+image_cols = tuple(dict.fromkeys(c for c in (amazon_url_col, grossista_img_col, amazon_img_col) if c))
+df = csv_store.columns(image_cols)
+match_state = init_match_state(content_hash, csv_store.num_rows, reviewer)
+caption.caption(f"Righe: {len(df):,}  |  Colonne: {len(cols)}  |  {csv_dialect.describe()}")
+if st.session_state.match_state_restored:
+    st.caption(f"Ripristinate {st.session_state.match_state_restored:,} decisioni dal journal di revisione.")
+
+
+# -----------------------------
+# Piano download (deduplica sull'intero file)
+# -----------------------------
+plan = plan_downloads(content_hash, df, amazon_url_col, amazon_img_col, grossista_img_col)
+st.caption(
+    f"Piano download: {len(plan.amazon_refs):,} pagine Amazon uniche ({plan.amazon_cached:,} già in cache)  |  "
+    f"{len(plan.image_refs):,} URL immagine unici  |  ~{plan.network_ops():,} operazioni di rete in totale"
+)
+dedupe_caption.caption(f"Fetch evitati grazie alla chiave ASIN: {plan.saved_fetches():,}")
+
+
+# -----------------------------
+# Triage: punteggi su tutto il file, decisioni automatiche, coda delle coppie incerte
+# -----------------------------
+plan_key = (content_hash, amazon_url_col, amazon_img_col, grossista_img_col)
+row_scores = get_row_scores(plan_key, len(df))
+suggestions = get_repair_suggestions(plan_key, len(df))
+
+if run_scoring:
+    progress = st.progress(0.0, text="Calcolo punteggi...")
+    stats = score_file(plan, row_scores, suggestions, max_workers, progress)
+    progress.empty()
+    st.session_state.feature_stats = stats
+    # decisioni automatiche solo in modalità triage (o con il bottone delle soglie): il calcolo
+    # serve anche ai soli suggerimenti di riabbinamento
+    apply_triage = apply_triage or triage_on
+
+stats = st.session_state.get("feature_stats")
+if stats is not None:
+    st.caption(
+        f"Feature: {stats.extracted:,} immagini nuove ({stats.failed:,} download falliti) in {stats.seconds:.1f} s  |  "
+        f"{stats.images_per_sec():.1f} img/s  |  capacità CPU: {stats.cpu_images_per_sec():.0f} img/s "
+        f"su {stats.processes} processi"
+    )
+
+if apply_triage:
+    # solo le righe non ancora decise: il triage non sovrascrive mai un revisore
+    match_ids, no_match_ids = row_scores.auto_decisions(low, high)
+    ids = np.concatenate([match_ids, no_match_ids])
+    values = np.concatenate([np.ones(len(match_ids), dtype=bool), np.zeros(len(no_match_ids), dtype=bool)])
+    todo = match_state.states[ids] == UNREVIEWED
+    if todo.any():
+        match_state.set_auto(ids[todo], values[todo])
+        clear_match_widgets(ids[todo])
+    auto_match, auto_no_match = int(todo[:len(match_ids)].sum()), int(todo[len(match_ids):].sum())
+    st.toast(f"Triage: {auto_match:,} MATCH e {auto_no_match:,} no match automatici")
+
+score_caption.caption(
+    f"Righe con punteggio: {int(row_scores.done.sum()):,}/{len(df):,}  |  "
+    f"MATCH sopra soglia: {int((row_scores.scores >= high).sum()):,}  |  "
+    f"no match sotto soglia: {int((row_scores.scores < low).sum()):,}"
+)
+if suggestions.ready:
+    repair_caption.caption(
+        f"Righe con un abbinamento migliore: {len(suggestions.queue(row_scores.scores, min_gain)):,}  |  "
+        f"ricerca affidabile per similarità ≥ {MIN_RELIABLE_SCORE}/100: sotto possono mancare suggerimenti"
+    )
+else:
+    repair_caption.caption("Si cercano in tutto il file con \"Calcola punteggi per tutto il file\" (Triage).")
+
+# ordine delle righe da sfogliare: il file, in triage la coda delle coppie incerte, oppure
+# le righe per cui c'è un'immagine grossista più simile, dal miglioramento più grande
+if repair_on:
+    row_order = suggestions.queue(row_scores.scores, min_gain)
+elif triage_on:
+    row_order = row_scores.triage_queue(low, high)
+else:
+    row_order = np.arange(len(df))
 
 
 # -----------------------------
 # Paginazione
 # -----------------------------
-total_pages = max(1, (len(df) + page_size - 1) // page_size)
+total_pages = max(1, (len(row_order) + page_size - 1) // page_size)
 
 c1, c2, c3, c4 = st.columns([1, 2, 2, 1])
 with c1:
-    page = st.number_input("Pagina", min_value=1, max_value=total_pages, value=1, step=1)
+    if st.session_state.get("page", 1) > total_pages:
+        st.session_state.page = total_pages
+    page = st.number_input("Pagina", min_value=1, max_value=total_pages, step=1, key="page")
 with c2:
     st.write("")
     st.write(f"Totale pagine: **{total_pages}**")
@@ -220,39 +721,108 @@ with c3:
     st.write(f"Proxy attivo: **{'Sì' if PROXIES else 'No'}**")
 with c4:
     st.write("")
-    if st.button("Reset match"):
-        st.session_state.match_map = {}  # type: ignore
+    # solo le decisioni di questo revisore (e del triage applicato da lui): quelle degli altri restano
+    if st.button("Annulla le mie decisioni", help="Anche le decisioni automatiche del triage applicato da te."):
+        clear_match_widgets(match_state.reset())
         st.rerun()
 
+# start/end: posizioni in row_order; page_ids: righe del file da mostrare
 start = (page - 1) * page_size
-end = min(len(df), start + page_size)
-page_df = df.iloc[start:end].copy()
+end = min(len(row_order), start + page_size)
+page_ids = row_order[start:end]
+
+# revisione condivisa: ognuno lavora sulle pagine in lease, le altre restano libere
+r1, r2, r3 = st.columns([1, 1, 3])
+with r1:
+    st.button(
+        "Pagina revisionata",
+        on_click=complete_page,
+        args=(content_hash, page_ids, page_size, not (triage_on or repair_on)),
+        help="Le righe della pagina ancora da vedere diventano \"No match\".",
+    )
+with r2:
+    st.button(
+        "Prossima pagina da revisionare",
+        on_click=claim_next_page,
+        args=(content_hash, page_size),
+        # i lease sono intervalli di righe del file: le code di triage e riabbinamento non li seguono
+        disabled=triage_on or repair_on,
+    )
+with r3:
+    if repair_on:
+        st.caption(f"Riabbinamento: {len(row_order):,} righe con un'immagine grossista più simile.")
+    elif triage_on:
+        st.caption(f"Triage: {len(row_order):,} coppie da rivedere, dalla più incerta.")
+    else:
+        REVIEW_JOURNAL.renew(content_hash, reviewer, start, end)
+        others = REVIEW_JOURNAL.holders(content_hash, start, end, reviewer)
+        if st.session_state.pop("no_pages_left", False):
+            st.success("Nessuna pagina libera da revisionare.")
+        elif others:
+            st.warning(f"Pagina in revisione da: {', '.join(others)}")
+        else:
+            st.caption(f"Revisori attivi su questo file: {REVIEW_JOURNAL.active_reviewers(content_hash)}")
 
 st.divider()
 
 # -----------------------------
 # Render righe (solo pagina)
 # -----------------------------
-for idx, row in page_df.iterrows():
-    row_id = int(idx)
+prefetcher = get_prefetcher(max_workers)
+prefetch_target = (
+    content_hash, int(page), page_size, prefetch_pages, amazon_url_col, amazon_img_col, grossista_img_col,
+    triage_on, low, high, repair_on, min_gain,
+)
+# cambio pagina/impostazioni: libera i worker per la pagina visibile
+prefetcher.cancel_if_stale(prefetch_target)
+
+# immagini grossista suggerite per le righe della pagina, scaricate insieme alle altre
+suggested: Dict[int, List[Tuple[int, float, str]]] = {}
+if suggestions.ready and shown_suggestions:
+    gross_urls = plan.rows["gross_image"]
+    for row_id in page_ids.tolist():
+        suggested[row_id] = [(r, s, gross_urls.iat[r]) for r, s in suggestions.for_row(row_id, shown_suggestions)]
+
+with st.spinner("Caricamento immagini della pagina..."), measure_throttle() as throttle:
+    page_images = resolve_page_images(plan.rows.iloc[page_ids], max_workers, suggested)
+row_scores.update(list(page_images), [images.score for images in page_images.values()])
+# solo le richieste partite davvero per questa pagina: con tutto in cache è 0
+st.caption(
+    f"Richieste in rete per la pagina: {throttle.total_requests():,}  |  "
+    f"tempo perso per il rate limit: {throttle.wall_waited():.2f} s"
+    + "".join(f"  |  {cls}: {w:.2f} s (somma dei thread)" for cls, w in sorted(throttle.waited.items()) if w > 0)
+)
+
+if prefetch_pages > 0:
+    prefetcher.schedule(prefetch_target, plan.rows.iloc[row_order[end:end + prefetch_pages * page_size]])
+
+
+@st.fragment
+def render_row(row_id: int, images: RowImages, details: Dict[str, Any]):
+    """
+    Card di una riga. È un fragment: la scelta dell'esito riesegue solo questa funzione,
+    senza ridisegnare le altre card né ripassare dalla cache immagini.
+    """
     with st.container(border=True):
         top = st.columns([1, 3, 3, 5])
 
-        # Checkbox
+        # Esito: "da vedere" resta distinto da "visto, non è un match"
         with top[0]:
             current = get_match(row_id)
-            new_val = st.checkbox("MATCH", value=current, key=f"match_{row_id}")
+            new_val = st.radio(
+                "Esito", list(STATE_LABELS), index=current, format_func=STATE_LABELS.get, key=f"match_{row_id}"
+            )
             if new_val != current:
                 set_match(row_id, new_val)
+            if images.score is not None:
+                st.caption(f"Similarità: **{images.score}**/100")
 
         # Amazon image
         with top[1]:
             st.caption("Amazon")
-            amazon_img_url = get_amazon_image_url(row, amazon_url_col, amazon_img_col)
-            if amazon_img_url:
-                img_bytes = download_image_bytes(amazon_img_url)
-                if img_bytes:
-                    st.image(img_bytes, use_column_width=True)
+            if images.amazon_url:
+                if images.amazon_bytes:
+                    st.image(images.amazon_bytes, use_column_width=True)
                 else:
                     st.warning("Immagine Amazon non scaricabile.")
             else:
@@ -261,11 +831,9 @@ for idx, row in page_df.iterrows():
         # Grossista image
         with top[2]:
             st.caption("Grossista")
-            gross_url = str(row[grossista_img_col]).strip() if pd.notna(row[grossista_img_col]) else ""
-            if gross_url:
-                img_bytes = download_image_bytes(gross_url)
-                if img_bytes:
-                    st.image(img_bytes, use_column_width=True)
+            if images.gross_url:
+                if images.gross_bytes:
+                    st.image(images.gross_bytes, use_column_width=True)
                 else:
                     st.warning("Immagine Grossista non scaricabile.")
             else:
@@ -274,17 +842,27 @@ for idx, row in page_df.iterrows():
         # Altre colonne
         with top[3]:
             st.caption("Dettagli")
-            data = {}
-            for c in show_cols:
-                v = row.get(c, "")
-                if pd.isna(v):
-                    v = ""
-                data[c] = v
-            st.json(data, expanded=False)
-
-        # piccola pausa per non sparare troppe richieste (soprattutto og:image Amazon)
-        if rate_limit_ms > 0 and amazon_img_col is None:
-            time.sleep(rate_limit_ms / 1000.0)
+            st.json(details, expanded=False)
+
+        # Abbinamenti alternativi: immagini grossista di altre righe più simili a quella Amazon
+        if images.suggestions:
+            st.caption("Immagini grossista più simili in tutto il file")
+            alternatives = st.columns(TOP_K)
+            for col, (alt_row, alt_score, alt_bytes) in zip(alternatives, images.suggestions):
+                with col:
+                    if alt_bytes:
+                        st.image(alt_bytes, use_column_width=True)
+                    st.caption(f"Riga {alt_row + 1}: **{alt_score:.0f}**/100")
+
+
+details_df = csv_store.take(page_ids, show_cols) if show_cols else None
+
+for row_id in page_ids.tolist():
+    details = {}
+    for c in show_cols:
+        v = details_df.at[row_id, c]
+        details[c] = "" if pd.isna(v) else v
+    render_row(row_id, page_images[row_id], details)
 
 st.divider()
 
@@ -292,18 +870,84 @@ st.divider()
 # -----------------------------
 # Export CSV con colonna MATCH
 # -----------------------------
-st.subheader("Esporta CSV con MATCH")
+# export generati: uno per (file, stato delle decisioni), condivisi tra sessioni e rimossi
+# come gli upload (LRU) quando superano il budget o l'età massima
+EXPORT_DIR = os.path.join(CACHE_DIR, "exports")
+EXPORT_CACHE_BYTES = 1024 ** 3
+EXPORT_MAX_AGE = 24 * 60 * 60
 
-match_map: Dict[int, bool] = st.session_state.match_map  # type: ignore
-out = df.copy()
-out["MATCH"] = [bool(match_map.get(i, False)) for i in range(len(out))]
 
-csv_bytes = out.to_csv(index=False).encode("utf-8")
+def write_export(content_hash: str, store: ColumnStore, state: MatchState) -> str:
+    """
+    Scrive il CSV completo con MATCH in EXPORT_DIR, un blocco alla volta: in memoria c'è al più
+    un blocco dello store. Il nome dipende dal file e dalle decisioni: uno stato già esportato
+    (anche da un'altra sessione) non si riscrive. Restituisce il percorso.
+    """
+    digest = hashlib.sha256(state.states.tobytes()).hexdigest()[:16]
+    path = os.path.join(EXPORT_DIR, f"{content_hash[:16]}-{digest}.csv")
+    if os.path.exists(path):
+        os.utime(path)
+        return path
+    os.makedirs(EXPORT_DIR, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=EXPORT_DIR, suffix=".csv.tmp")
+    with open(fd, "w", encoding="utf-8", newline="") as f:
+        for i, block in enumerate(store.iter_frames()):
+            block["MATCH"] = state.match_column(block.index[0], block.index[-1] + 1)
+            block.to_csv(f, index=False, header=i == 0)
+    os.replace(tmp, path)
+    prune_files(EXPORT_DIR, EXPORT_CACHE_BYTES, EXPORT_MAX_AGE, keep=[path])
+    return path
+
+
+@st.fragment
+def export_section(content_hash: str, store: ColumnStore, page_size: int):
+    """Fragment: il bottone di export riesegue solo questa sezione."""
+    match_state: MatchState = st.session_state.match_state
+    # l'export si genera solo su richiesta e solo se le decisioni sono cambiate dall'ultimo
+    # (revisione dello stato): le scelte sulle card non dipendono dalla dimensione del file
+    export_file = st.session_state.get("export_file")  # (content_hash, revisione, percorso)
+    export_fresh = export_file is not None and export_file[:2] == (content_hash, match_state.revision)
+
+    if st.button("Prepara CSV completo per il download"):
+        # il file può essere stato rimosso dalla pulizia degli export
+        if not export_fresh or not os.path.exists(export_file[2]):
+            with st.spinner("Generazione export..."):
+                path = write_export(content_hash, store, match_state)
+            export_file = (content_hash, match_state.revision, path)
+            st.session_state.export_file = export_file
+
+        with open(export_file[2], "rb") as f:
+            st.download_button(
+                "Download CSV (con MATCH)",
+                data=f,
+                file_name="output_with_match.csv",
+                mime="text/csv",
+            )
+    elif export_file is not None and export_file[0] == content_hash and not export_fresh:
+        st.caption("Decisioni modificate dopo l'ultimo export: preparalo di nuovo per includerle.")
+
+    # il controllo legge tutto il journal del file: solo su richiesta, non a ogni rerun
+    checked = st.session_state.get("conflicts")  # (content_hash, seq del journal, righe)
+    if st.button("Cerca decisioni discordanti tra revisori"):
+        checked = (content_hash, match_state.seq, REVIEW_JOURNAL.conflicts(content_hash))
+        st.session_state.conflicts = checked
+    if checked is not None and checked[0] == content_hash:
+        conflicts = checked[2]
+        stale = " Il journal è cambiato dal controllo: ripetilo per aggiornare." if checked[1] != match_state.seq else ""
+        if conflicts:
+            conflict_pages = sorted({r // page_size + 1 for r in conflicts})
+            st.warning(
+                f"Righe con decisioni discordanti tra revisori: {len(conflicts):,} (vale l'ultima). "
+                f"Pagine: {', '.join(map(str, conflict_pages[:20]))}{'...' if len(conflict_pages) > 20 else ''}.{stale}"
+            )
+        else:
+            st.caption(f"Nessuna decisione discordante tra revisori.{stale}")
+    review_counts = match_state.counts()
+    st.caption(
+        f"Match: {review_counts['match']:,}  |  No match: {review_counts['no_match']:,}  |  "
+        f"Non revisionate: {review_counts['non_revisionate']:,} (nell'export rimangono MATCH = False)."
+    )
+
 
-st.download_button(
-    "Download CSV (con MATCH)",
-    data=csv_bytes,
-    file_name="output_with_match.csv",
-    mime="text/csv",
-)
-st.caption("Le righe non controllate rimangono MATCH = False.")
+st.subheader("Esporta CSV con MATCH")
+export_section(content_hash, csv_store, page_size)
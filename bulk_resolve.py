@@ -0,0 +1,178 @@
+"""
+Risoluzione bulk, senza UI, degli URL immagine Amazon di un CSV.
+
+Legge lo stesso CSV caricato nell'app, risolve og:image per ogni pagina Amazon distinta
+(in parallelo, con rate limit per host) e scrive un CSV/Parquet arricchito con una colonna
+di URL immagine. Nell'app basta poi sceglierla in "Colonna URL immagine Amazon":
+durante la revisione non si fa più scraping.
+
+Ogni esito finisce subito nella cache persistente (vedi resolver.ImageUrlStore), che fa
+da checkpoint: se il processo si interrompe, rilanciandolo riparte da dove era arrivato.
+
+Con --grossista-img-col calcola anche le feature di tutte le immagini (features.extract_urls)
+e scrive una colonna con il punteggio di similarità per riga. Lo store delle feature è lo
+stesso dell'app: il triage in app ritrova tutto già calcolato, anche con l'app aperta.
+
+Esempio:
+  python bulk_resolve.py grossista.csv grossista_img.csv --amazon-url-col "Link Amazon"
+  python bulk_resolve.py grossista.csv grossista_img.parquet --amazon-url-col "Link Amazon" --amazon-rps 4
+  python bulk_resolve.py grossista.csv grossista_score.csv --amazon-url-col "Link Amazon" --grossista-img-col "Foto"
+"""
+import argparse
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Dict, List, Optional
+
+import pandas as pd
+
+from features import FEATURE_STORE_PATH, FeatureStore, extract_urls, pair_scores
+from ingest import load_csv
+from resolver import (
+    DEFAULT_HOST_RATES,
+    IMAGE_STORE_PATH,
+    MAX_WORKERS,
+    HostRateLimiter,
+    ImageUrlStore,
+    build_download_plan,
+    build_session,
+    fetch_image_bytes,
+    fetch_og_image,
+    get_proxy_config,
+    lookup_image_url,
+)
+
+
+def write_output(df: pd.DataFrame, path: str) -> None:
+    if path.lower().endswith(".parquet"):
+        try:
+            df.to_parquet(path, index=False)
+        except ImportError:
+            sys.exit("Per scrivere Parquet serve pyarrow (pip install pyarrow), oppure usa un output .csv")
+    else:
+        df.to_csv(path, index=False)
+
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    p = argparse.ArgumentParser(description="Arricchisce un CSV con gli URL immagine Amazon (og:image).")
+    p.add_argument("input", help="CSV del grossista (lo stesso caricato nell'app)")
+    p.add_argument("output", help="file di output: .csv oppure .parquet")
+    p.add_argument("--amazon-url-col", required=True, help="colonna con gli URL Amazon")
+    p.add_argument(
+        "--amazon-img-col",
+        default=None,
+        help="colonna URL immagine Amazon già presente: dove è valorizzata non si fa fetch",
+    )
+    p.add_argument("--output-col", default="amazon_image_url", help="colonna da scrivere (default: %(default)s)")
+    p.add_argument("--workers", type=int, default=8, help=f"fetch paralleli, max {MAX_WORKERS} (default: %(default)s)")
+    p.add_argument(
+        "--amazon-rps",
+        type=float,
+        default=DEFAULT_HOST_RATES["amazon"],
+        help="richieste/secondo per host Amazon, 0 = nessun limite (default: %(default)s)",
+    )
+    p.add_argument("--cache", default=IMAGE_STORE_PATH, help="cache/checkpoint SQLite (default: %(default)s)")
+    p.add_argument(
+        "--grossista-img-col",
+        default=None,
+        help="colonna URL immagine grossista: se indicata, calcola anche il punteggio di similarità per riga",
+    )
+    p.add_argument("--score-col", default="similarity_score", help="colonna del punteggio (default: %(default)s)")
+    p.add_argument(
+        "--processes", type=int, default=None, help="processi per le feature immagine (default: uno per core)"
+    )
+    p.add_argument("--features", default=FEATURE_STORE_PATH, help="store delle feature (default: %(default)s)")
+    return p.parse_args(argv)
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    args = parse_args(argv)
+
+    try:
+        df, dialect = load_csv(args.input)
+    except pd.errors.ParserError as e:
+        sys.exit(f"CSV non leggibile: {e}")
+    print(dialect.describe(), file=sys.stderr)
+    for col in (args.amazon_url_col, args.amazon_img_col, args.grossista_img_col):
+        if col and col not in df.columns:
+            sys.exit(f"Colonna non trovata: {col!r}. Colonne disponibili: {', '.join(map(str, df.columns))}")
+
+    store = ImageUrlStore(args.cache)
+    plan = build_download_plan(df, args.amazon_url_col, args.amazon_img_col, args.grossista_img_col, store)
+    keys = plan.amazon_refs.index.tolist()
+    print(
+        f"Righe: {len(df):,}  |  pagine Amazon uniche: {len(keys):,}  |  già in cache: {plan.amazon_cached:,}  |  "
+        f"fetch evitati dalla chiave ASIN: {plan.saved_fetches():,}",
+        file=sys.stderr,
+    )
+
+    session = build_session()
+    proxies = get_proxy_config()
+    limiter = HostRateLimiter({**DEFAULT_HOST_RATES, "amazon": args.amazon_rps})
+
+    def resolve(url: str):
+        return fetch_og_image(url, session, proxies, limiter)
+
+    results: Dict[str, Optional[str]] = {}
+    started = time.monotonic()
+    last_report = started
+    pool = ThreadPoolExecutor(max_workers=max(1, min(args.workers, MAX_WORKERS)))
+    try:
+        futures = {pool.submit(lookup_image_url, key, store, resolve): key for key in keys}
+        for done, fut in enumerate(as_completed(futures), 1):
+            results[futures[fut]] = fut.result()
+            now = time.monotonic()
+            if now - last_report >= 5 or done == len(futures):
+                found = sum(1 for v in results.values() if v)
+                print(
+                    f"  {done:,}/{len(futures):,} pagine  |  immagini trovate: {found:,}  |  "
+                    f"{done / max(now - started, 1e-9):.1f} pag/s",
+                    file=sys.stderr,
+                )
+                last_report = now
+    except KeyboardInterrupt:
+        pool.shutdown(wait=False, cancel_futures=True)
+        print("Interrotto: i risultati sono nella cache, rilancia per riprendere.", file=sys.stderr)
+        return 130
+    pool.shutdown()
+
+    # risultati per chiave → righe; l'URL diretto (se c'è) ha la precedenza
+    resolved = plan.rows["amazon_key"].map(results)
+    df[args.output_col] = plan.rows["amazon_image"].astype(object).where(plan.rows["amazon_image"].notna(), resolved)
+    if args.grossista_img_col:
+        gross_col = plan.rows["gross_image"].astype(object)
+        urls = pd.concat([df[args.output_col], gross_col]).dropna().unique().tolist()
+
+        def report(done: int, total: int, rate: float) -> None:
+            print(f"  {done:,}/{total:,} immagini  |  {rate:.1f} img/s", file=sys.stderr)
+
+        feature_store = FeatureStore(args.features)
+        try:
+            stats = extract_urls(
+                urls,
+                lambda url: fetch_image_bytes(url, session, proxies, limiter),
+                feature_store,
+                download_workers=max(1, min(args.workers, MAX_WORKERS)),
+                processes=args.processes,
+                progress=report,
+            )
+        except KeyboardInterrupt:
+            print("Interrotto: le feature calcolate sono nello store, rilancia per riprendere.", file=sys.stderr)
+            return 130
+        print(
+            f"Feature: {stats.extracted:,} calcolate, {stats.failed:,} download falliti  |  "
+            f"{stats.images_per_sec():.1f} img/s con {stats.processes} processi",
+            file=sys.stderr,
+        )
+        df[args.score_col] = pair_scores(feature_store, df[args.output_col], gross_col)
+
+    write_output(df, args.output)
+    print(
+        f"Scritto {args.output}: {df[args.output_col].notna().sum():,}/{len(df):,} righe con URL immagine Amazon",
+        file=sys.stderr,
+    )
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
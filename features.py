@@ -0,0 +1,367 @@
+"""
+Estrazione batch delle feature immagine (hash percettivi + istogramma colore) sull'intero
+file, senza dipendenze da Streamlit.
+
+Download in thread (I/O, rate limit per host), decodifica e calcolo in un pool di processi
+(CPU, un processo per core). Le feature finiscono in FeatureStore, con chiave lo SHA-256
+dei byte dell'immagine: lo stesso contenuto a URL diversi si calcola una volta sola.
+Lo store è un insieme di segmenti .npy in memory map più un indice SQLite.
+"""
+import hashlib
+import multiprocessing
+import os
+import sqlite3
+import threading
+import time
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Callable, Dict, Iterable, List, NamedTuple, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+
+from resolver import CACHE_DIR
+from similarity import HASH_BYTES, HIST_BINS, image_features, pack_hashes, packed_scores
+
+FEATURE_STORE_PATH = os.path.join(CACHE_DIR, "features")
+HIST_SIZE = HIST_BINS ** 3
+# righe per segmento .npy: 64K x (24 + 256) byte ≈ 18 MB per segmento
+SEGMENT_ROWS = 64 * 1024
+
+# immagini per task del pool di processi: ammortizza il costo di pickling/IPC
+CHUNK_IMAGES = 32
+# URL scaricati per finestra: limita i byte in memoria in attesa del pool di processi
+WINDOW_URLS = 1024
+
+
+def content_hash(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()
+
+
+FeatureRecord = Tuple[str, Optional[bytes], Optional[bytes]]  # (sha, hash impacchettati, istogramma)
+
+
+def feature_record(sha: str, data: bytes) -> FeatureRecord:
+    features = image_features(data)
+    if features is None:
+        return sha, None, None
+    return sha, pack_hashes(features[0]).tobytes(), features[1].tobytes()
+
+
+def _extract_chunk(items: List[Tuple[str, bytes]]) -> Tuple[List[FeatureRecord], float]:
+    # gira nei processi del pool: riceve (sha, byte), restituisce i record e i secondi di CPU
+    # spesi, per misurare il throughput indipendentemente dalla rete
+    started = time.perf_counter()
+    out = [feature_record(sha, data) for sha, data in items]
+    return out, time.perf_counter() - started
+
+
+class FeatureStore:
+    """
+    Store delle feature per contenuto immagine (SHA-256), condiviso da app, CLI e job di scoring,
+    anche in processi diversi.
+
+    I vettori a larghezza fissa stanno in segmenti .npy da SEGMENT_ROWS righe, aperti in memory
+    map: ogni contenuto ha uno slot globale (segmento = slot // SEGMENT_ROWS). L'indice
+    SHA-256 → slot e la mappa URL → SHA-256 sono in SQLite (WAL); ogni processo ne tiene una
+    copia in memoria, aggiornata solo con le voci nuove, così una lookup per un'intera pagina
+    o un intero file è una get_indexer più un fancy indexing per segmento.
+    Un contenuto non decodificabile ha slot -1 (noto, ma senza feature: non si ricalcola).
+    """
+
+    def __init__(self, path: str):
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(os.path.join(path, "index.sqlite"), check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS feature_index (
+                seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                sha256 TEXT NOT NULL UNIQUE,
+                slot INTEGER NOT NULL
+            )
+            """
+        )
+        self._conn.execute("CREATE TABLE IF NOT EXISTS store_meta (key TEXT PRIMARY KEY, value INTEGER NOT NULL)")
+        self._conn.execute("INSERT OR IGNORE INTO store_meta VALUES ('next_slot', 0)")
+        self._conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS image_urls (
+                url TEXT PRIMARY KEY,
+                sha256 TEXT NOT NULL,
+                fetched_at REAL NOT NULL
+            )
+            """
+        )
+        # copia in memoria dell'indice: sha → slot, fino alla voce seq
+        self._seq = 0
+        self._index = pd.Index([], dtype=object)
+        self._slots = np.empty(0, dtype=np.int64)
+        self._segments: Dict[int, Tuple[np.ndarray, np.ndarray]] = {}
+
+    # -----------------------------
+    # Segmenti .npy
+    # -----------------------------
+    def _segment_paths(self, segment: int) -> Tuple[str, str]:
+        base = os.path.join(self.path, f"seg-{segment:05d}")
+        return base + ".hashes.npy", base + ".hist.npy"
+
+    def _segment(self, segment: int, create: bool = False) -> Tuple[np.ndarray, np.ndarray]:
+        # chiamante con self._lock; create solo dentro la transazione che riserva gli slot
+        if segment not in self._segments:
+            hashes_path, hist_path = self._segment_paths(segment)
+            if create and not os.path.exists(hist_path):
+                # file a dimensione piena (sparsi su disco): chi li mappa dopo vede tutto il segmento
+                for path, dtype, width in ((hashes_path, np.uint8, HASH_BYTES), (hist_path, np.float32, HIST_SIZE)):
+                    np.lib.format.open_memmap(path + ".tmp", mode="w+", dtype=dtype, shape=(SEGMENT_ROWS, width)).flush()
+                    os.replace(path + ".tmp", path)
+            self._segments[segment] = (
+                np.load(hashes_path, mmap_mode="r+"),
+                np.load(hist_path, mmap_mode="r+"),
+            )
+        return self._segments[segment]
+
+    # -----------------------------
+    # Indice
+    # -----------------------------
+    def _refresh(self) -> None:
+        # chiamante con self._lock: aggiunge le voci scritte (anche da altri processi) dall'ultima lettura
+        rows = self._conn.execute(
+            "SELECT seq, sha256, slot FROM feature_index WHERE seq > ? ORDER BY seq", (self._seq,)
+        ).fetchall()
+        if not rows:
+            return
+        self._seq = rows[-1][0]
+        self._index = self._index.append(pd.Index([r[1] for r in rows], dtype=object))
+        self._slots = np.concatenate([self._slots, np.array([r[2] for r in rows], dtype=np.int64)])
+
+    def _lookup(self, shas: List[Optional[str]]) -> np.ndarray:
+        # slot per sha: -1 se senza feature, -2 se sconosciuto
+        self._refresh()
+        if not len(self._index):
+            return np.full(len(shas), -2, dtype=np.int64)
+        pos = self._index.get_indexer([s or "" for s in shas])
+        return np.where(pos >= 0, self._slots[pos], -2)
+
+    def known(self, shas: List[str]) -> set:
+        with self._lock:
+            slots = self._lookup(shas)
+        return {sha for sha, slot in zip(shas, slots) if slot != -2}
+
+    def put_many(self, records: Iterable[FeatureRecord]) -> None:
+        records = list(records)
+        with self._lock:
+            slots = self._lookup([r[0] for r in records])
+            records = [r for r, slot in zip(records, slots) if slot == -2]
+            decodable = [r for r in records if r[1] is not None]
+            if not records:
+                return
+            # riserva gli slot in modo atomico tra processi (IMMEDIATE = lock di scrittura)
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                first = self._conn.execute("SELECT value FROM store_meta WHERE key = 'next_slot'").fetchone()[0]
+                self._conn.execute(
+                    "UPDATE store_meta SET value = ? WHERE key = 'next_slot'", (first + len(decodable),)
+                )
+                for segment in range(first // SEGMENT_ROWS, (first + len(decodable) - 1) // SEGMENT_ROWS + 1):
+                    self._segment(segment, create=True)
+                self._conn.execute("COMMIT")
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+
+            new_slots = np.arange(first, first + len(decodable))
+            hashes = np.frombuffer(b"".join(r[1] for r in decodable), dtype=np.uint8).reshape(-1, HASH_BYTES)
+            hists = np.frombuffer(b"".join(r[2] for r in decodable), dtype=np.float32).reshape(-1, HIST_SIZE)
+            for segment in np.unique(new_slots // SEGMENT_ROWS):
+                sel = new_slots // SEGMENT_ROWS == segment
+                seg_hashes, seg_hists = self._segment(int(segment))
+                seg_hashes[new_slots[sel] % SEGMENT_ROWS] = hashes[sel]
+                seg_hists[new_slots[sel] % SEGMENT_ROWS] = hists[sel]
+                seg_hashes.flush()
+                seg_hists.flush()
+            # l'indice si scrive dopo i dati: chi trova uno slot trova anche le feature
+            slot_of = dict(zip((r[0] for r in decodable), new_slots.tolist()))
+            self._conn.executemany(
+                "INSERT OR IGNORE INTO feature_index (sha256, slot) VALUES (?, ?)",
+                [(r[0], slot_of.get(r[0], -1)) for r in records],
+            )
+
+    def gather(self, shas: List[Optional[str]]) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Feature per una lista di SHA (anche ripetuti o None): (valid bool (n,), hash uint8 (n, 24),
+        istogrammi float32 (n, 64)). Le righe non valide sono a zero.
+        """
+        hashes = np.zeros((len(shas), HASH_BYTES), dtype=np.uint8)
+        hists = np.zeros((len(shas), HIST_SIZE), dtype=np.float32)
+        with self._lock:
+            slots = self._lookup(shas)
+            valid = slots >= 0
+            for segment in np.unique(slots[valid] // SEGMENT_ROWS):
+                sel = valid & (slots // SEGMENT_ROWS == segment)
+                seg_hashes, seg_hists = self._segment(int(segment))
+                hashes[sel] = seg_hashes[slots[sel] % SEGMENT_ROWS]
+                hists[sel] = seg_hists[slots[sel] % SEGMENT_ROWS]
+        return valid, hashes, hists
+
+    def gather_urls(self, urls: Iterable) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """Come gather, per una colonna di URL immagine (NA dove manca l'URL)."""
+        urls = [u if isinstance(u, str) else None for u in urls]
+        shas = self.url_shas(sorted({u for u in urls if u}))
+        return self.gather([shas.get(u) for u in urls])
+
+    # -----------------------------
+    # URL → contenuto
+    # -----------------------------
+    def put_urls(self, pairs: Iterable[Tuple[str, str]]) -> None:
+        now = time.time()
+        with self._lock:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO image_urls VALUES (?, ?, ?)", [(u, sha, now) for u, sha in pairs]
+            )
+
+    def url_shas(self, urls: List[str]) -> Dict[str, str]:
+        found: Dict[str, str] = {}
+        with self._lock:
+            for i in range(0, len(urls), 500):
+                chunk = urls[i:i + 500]
+                found.update(
+                    self._conn.execute(
+                        f"SELECT url, sha256 FROM image_urls WHERE url IN ({','.join('?' * len(chunk))})", chunk
+                    ).fetchall()
+                )
+        return found
+
+    def count(self) -> int:
+        with self._lock:
+            self._refresh()
+            return len(self._index)
+
+
+def pair_scores(store: FeatureStore, left: Iterable, right: Iterable) -> np.ndarray:
+    """
+    Punteggi 0–100 per coppie di URL immagine (due colonne allineate, NA dove manca l'URL),
+    con un solo gather per colonna sullo store; NaN dove una delle due immagini non ha feature.
+    """
+    valid_l, hashes_l, _ = store.gather_urls(left)
+    valid_r, hashes_r, _ = store.gather_urls(right)
+    scores = packed_scores(hashes_l, hashes_r)
+    scores[~(valid_l & valid_r)] = np.nan
+    return scores
+
+
+def default_processes() -> int:
+    return max(1, os.cpu_count() or 1)
+
+
+def _mp_context():
+    # niente fork di un processo con thread attivi (server Streamlit, pool di download)
+    methods = multiprocessing.get_all_start_methods()
+    return multiprocessing.get_context("forkserver" if "forkserver" in methods else "spawn")
+
+
+class ExtractionStats(NamedTuple):
+    urls: int  # URL da elaborare (non ancora nello store)
+    downloaded: int
+    failed: int  # download falliti
+    extracted: int  # contenuti nuovi calcolati nel pool di processi
+    processes: int
+    seconds: float  # tempo totale, download compresi
+    cpu_seconds: float  # somma del tempo di calcolo nei processi
+
+    def images_per_sec(self) -> float:
+        """Throughput complessivo (rete compresa)."""
+        return self.extracted / self.seconds if self.seconds > 0 else 0.0
+
+    def cpu_images_per_sec(self) -> float:
+        """Capacità del pool di processi: immagini/s per core x numero di processi."""
+        return self.extracted / self.cpu_seconds * self.processes if self.cpu_seconds > 0 else 0.0
+
+
+def extract_urls(
+    urls: List[str],
+    fetch: Callable[[str], Optional[bytes]],
+    store: FeatureStore,
+    download_workers: int,
+    processes: Optional[int] = None,
+    progress: Optional[Callable[[int, int, float], None]] = None,
+) -> ExtractionStats:
+    """
+    Scarica e calcola le feature degli URL non ancora nello store. fetch: download (con rate limit).
+    progress(fatti, totale, immagini/s) viene chiamato dopo ogni finestra di download.
+    Un URL entra nella mappa URL → contenuto solo dopo che le feature del contenuto sono nello
+    store: un'esecuzione interrotta riprende dagli URL senza feature.
+    """
+    known_urls = store.url_shas(urls)
+    # anche la mappa scritta da versioni precedenti può puntare a contenuti senza feature
+    stored = store.known(list(set(known_urls.values())))
+    todo = [u for u in dict.fromkeys(urls) if known_urls.get(u) not in stored]
+    processes = processes or default_processes()
+    started = time.monotonic()
+    downloaded = failed = extracted = 0
+    cpu_seconds = 0.0
+    queued: set = set()
+    pending: List[Future] = []
+    # sha in coda al pool → URL da registrare quando le sue feature sono salvate
+    waiting: Dict[str, List[str]] = {}
+
+    def collect(block: bool) -> None:
+        nonlocal extracted, cpu_seconds
+        still = []
+        for fut in pending:
+            if block or fut.done():
+                records, seconds = fut.result()
+                store.put_many(records)
+                store.put_urls([(url, sha) for sha, _, _ in records for url in waiting.pop(sha, ())])
+                extracted += len(records)
+                cpu_seconds += seconds
+            else:
+                still.append(fut)
+        pending[:] = still
+
+    with ThreadPoolExecutor(max_workers=max(1, download_workers), thread_name_prefix="features") as io_pool, \
+            ProcessPoolExecutor(max_workers=processes, mp_context=_mp_context()) as cpu_pool:
+        for w in range(0, len(todo), WINDOW_URLS):
+            window = todo[w:w + WINDOW_URLS]
+            fetched = list(zip(window, io_pool.map(fetch, window)))
+            pairs, chunk = [], []
+            shas = {u: content_hash(d) for u, d in fetched if d is not None}
+            known = store.known(list(set(shas.values()) - queued))
+            for url, data in fetched:
+                if data is None:
+                    failed += 1
+                    continue
+                downloaded += 1
+                sha = shas[url]
+                if sha in known:
+                    pairs.append((url, sha))
+                    continue
+                waiting.setdefault(sha, []).append(url)
+                if sha in queued:
+                    continue
+                queued.add(sha)
+                chunk.append((sha, data))
+                if len(chunk) >= CHUNK_IMAGES:
+                    pending.append(cpu_pool.submit(_extract_chunk, chunk))
+                    chunk = []
+            if chunk:
+                pending.append(cpu_pool.submit(_extract_chunk, chunk))
+            store.put_urls(pairs)
+            # poco lavoro in coda al pool: i byte scaricati non si accumulano in memoria
+            collect(block=len(pending) > 2 * processes)
+            if progress:
+                elapsed = time.monotonic() - started
+                progress(w + len(window), len(todo), extracted / elapsed if elapsed > 0 else 0.0)
+        collect(block=True)
+
+    return ExtractionStats(
+        urls=len(todo),
+        downloaded=downloaded,
+        failed=failed,
+        extracted=extracted,
+        processes=processes,
+        seconds=time.monotonic() - started,
+        cpu_seconds=cpu_seconds,
+    )
@@ -0,0 +1,490 @@
+"""
+Lettura dei CSV dei grossisti: sniffing di encoding, separatore, quoting e riga di
+intestazione sui primi KB, poi un solo parsing con quei parametri.
+Il parsing usa il lettore CSV di pyarrow (colonne Arrow, solo quelle richieste);
+senza pyarrow si ripiega su pandas.read_csv con usecols.
+Per i file grandi l'app usa ColumnStore: il CSV viene convertito a blocchi in un file
+Arrow IPC su disco e letto via memory map (colonne e righe solo quando servono).
+Usato da app.py e da bulk_resolve.py.
+"""
+import codecs
+import csv
+import io
+import os
+import time
+import warnings
+from collections import Counter
+from typing import BinaryIO, Iterator, List, NamedTuple, Optional, Sequence, Tuple, Union
+
+import pandas as pd
+
+try:
+    import pyarrow as pa
+    import pyarrow.csv as pacsv
+except ImportError:  # pyarrow opzionale: parser di pandas
+    pa = None
+    pacsv = None
+
+# quanto leggere per lo sniffing
+SNIFF_BYTES = 64 * 1024
+CANDIDATE_DELIMITERS = (",", ";", "\t", "|")
+# in ordine: UTF-8 (con o senza BOM), poi Windows-1252 e Latin-1, comuni negli export italiani
+CANDIDATE_ENCODINGS = ("utf-8-sig", "cp1252", "latin-1")
+# righe del campione usate per contare i campi
+SNIFF_LINES = 50
+
+
+class CsvDialect(NamedTuple):
+    encoding: str
+    delimiter: str
+    quotechar: str
+    header_row: int  # righe da saltare prima dell'intestazione (titoli, note dell'export)
+    # parsing completato solo sostituendo i byte non decodificabili con U+FFFD
+    replaced: bool = False
+    # righe malformate (campi in più o in meno rispetto all'intestazione) saltate dal parsing
+    skipped_rows: int = 0
+
+    def describe(self) -> str:
+        sep = {"\t": "TAB"}.get(self.delimiter, self.delimiter)
+        text = f"Separatore: '{sep}'  |  Encoding: {self.encoding}  |  Quote: {self.quotechar}"
+        if self.header_row:
+            text += f"  |  Intestazione alla riga {self.header_row + 1}"
+        if self.replaced:
+            text += "  |  ATTENZIONE: caratteri non decodificabili sostituiti con �"
+        if self.skipped_rows:
+            text += f"  |  ATTENZIONE: {self.skipped_rows:,} righe malformate saltate"
+        return text
+
+
+def parse_encodings(dialect: CsvDialect) -> List[str]:
+    """
+    Encoding da provare nel parsing completo: quello del campione, poi i candidati successivi.
+    Un campione tutto ASCII risulta UTF-8 anche se più avanti il file ha byte Windows-1252.
+    """
+    names = [e if e != "utf-8-sig" else "utf-8" for e in CANDIDATE_ENCODINGS]
+    first = names.index("utf-8") if dialect.encoding.startswith("utf-8") else names.index(dialect.encoding)
+    return [dialect.encoding] + names[first + 1:]
+
+
+def _decode_sample(sample: bytes) -> Tuple[str, str]:
+    # il campione può troncare un carattere multibyte: si tiene solo fino all'ultima riga completa
+    if len(sample) >= SNIFF_BYTES and b"\n" in sample:
+        sample = sample[: sample.rindex(b"\n") + 1]
+    for encoding in CANDIDATE_ENCODINGS:
+        try:
+            text = sample.decode(encoding)
+        except UnicodeDecodeError:
+            continue
+        if encoding == "utf-8-sig" and not sample.startswith(codecs.BOM_UTF8):
+            encoding = "utf-8"
+        return text, encoding
+    # latin-1 decodifica qualsiasi byte: qui non si arriva
+    return sample.decode("latin-1"), "latin-1"
+
+
+def _field_counts(lines: List[str], delimiter: str, quotechar: str) -> List[int]:
+    reader = csv.reader(lines, delimiter=delimiter, quotechar=quotechar)
+    return [len(fields) for fields in reader if fields]
+
+
+def sniff_csv(sample: bytes) -> CsvDialect:
+    """
+    Deduce il dialetto dai primi byte del file. Il separatore scelto è quello che divide
+    il maggior numero di righe del campione nello stesso numero (> 1) di campi: un file
+    a punto e virgola letto con la virgola non "riesce" più come un'unica colonna.
+    """
+    text, encoding = _decode_sample(sample)
+    lines = text.splitlines()[:SNIFF_LINES]
+    if len(text) >= SNIFF_BYTES and len(lines) > 1:
+        lines = lines[:-1]  # l'ultima riga del campione può essere tagliata
+
+    quotechar = '"'
+    try:
+        sniffed = csv.Sniffer().sniff("\n".join(lines), delimiters="".join(CANDIDATE_DELIMITERS))
+        quotechar = sniffed.quotechar or '"'
+    except csv.Error:
+        pass
+
+    best_delimiter, best_score, best_width = ",", -1, 1
+    for delimiter in CANDIDATE_DELIMITERS:
+        counts = _field_counts(lines, delimiter, quotechar)
+        if not counts:
+            continue
+        width, agreeing = Counter(counts).most_common(1)[0]
+        if width < 2:
+            continue
+        if agreeing > best_score or (agreeing == best_score and width > best_width):
+            best_delimiter, best_score, best_width = delimiter, agreeing, width
+
+    # intestazione = prima riga con il numero di campi tipico (salta titoli/note iniziali)
+    header_row = 0
+    for i, line in enumerate(lines):
+        if _field_counts([line], best_delimiter, quotechar) == [best_width]:
+            header_row = i
+            break
+
+    return CsvDialect(encoding=encoding, delimiter=best_delimiter, quotechar=quotechar, header_row=header_row)
+
+
+def read_sample(source: Union[str, BinaryIO]) -> bytes:
+    if isinstance(source, str):
+        with open(source, "rb") as f:
+            return f.read(SNIFF_BYTES)
+    if isinstance(source, io.BytesIO):
+        return bytes(source.getbuffer()[:SNIFF_BYTES])
+    source.seek(0)
+    return source.read(SNIFF_BYTES)
+
+
+def unique_names(names: Sequence[str]) -> List[str]:
+    """
+    Nomi di colonna univoci come in pandas.read_csv: vuoti -> "Unnamed: i", duplicati -> "a.1",
+    "a.2"... saltando i suffissi già presenti nell'intestazione. Arrow non accetta selezioni
+    su colonne con lo stesso nome.
+    """
+    header = [name or f"Unnamed: {i}" for i, name in enumerate(names)]
+    original, used, next_suffix = set(header), set(), Counter()
+    result = []
+    for name in header:
+        column = name
+        if name in used:
+            suffix = next_suffix[name] or 1
+            while f"{name}.{suffix}" in original or f"{name}.{suffix}" in used:
+                suffix += 1
+            column = f"{name}.{suffix}"
+            next_suffix[name] = suffix + 1
+        used.add(column)
+        result.append(column)
+    return result
+
+
+def header_columns(sample: bytes, dialect: CsvDialect) -> List[str]:
+    """Nomi delle colonne letti dal campione, senza parsing del file (resi univoci, vedi unique_names)."""
+    text, _ = _decode_sample(sample)
+    lines = text.splitlines()[dialect.header_row:dialect.header_row + 1]
+    reader = csv.reader(lines, delimiter=dialect.delimiter, quotechar=dialect.quotechar)
+    return unique_names(next(reader, []))
+
+
+def sniff_source(source: Union[str, BinaryIO]) -> Tuple[CsvDialect, List[str]]:
+    """Dialetto e colonne del file, leggendo solo i primi SNIFF_BYTES."""
+    sample = read_sample(source)
+    dialect = sniff_csv(sample)
+    return dialect, header_columns(sample, dialect)
+
+
+class BadRows:
+    """
+    Conta le righe con un numero di campi diverso dall'intestazione, che il parsing salta
+    invece di fallire (una riga storta in un export da 100k righe non deve bloccare il file).
+    """
+
+    def __init__(self):
+        self.count = 0
+
+    def arrow_handler(self, row) -> str:
+        """invalid_row_handler di pyarrow.csv.ParseOptions."""
+        self.count += 1
+        return "skip"
+
+    def pandas_call(self, func, *args, **kwargs):
+        """Esegue func (parsing pandas con on_bad_lines="warn") contando le righe saltate."""
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter("always", pd.errors.ParserWarning)
+            result = func(*args, **kwargs)
+        for w in caught:
+            if issubclass(w.category, pd.errors.ParserWarning):
+                self.count += str(w.message).count("Skipping line")
+            else:
+                warnings.warn_explicit(w.message, w.category, w.filename, w.lineno)
+        return result
+
+
+def _read_arrow(
+    source: Union[str, BinaryIO],
+    dialect: CsvDialect,
+    names: List[str],
+    columns: Optional[Sequence[str]],
+    bad_rows: BadRows,
+) -> pd.DataFrame:
+    table = pacsv.read_csv(
+        source,
+        read_options=pacsv.ReadOptions(
+            # l'intestazione si salta: i nomi sono quelli resi univoci (header_columns)
+            skip_rows=dialect.header_row + 1,
+            column_names=names,
+            # il BOM UTF-8 viene saltato da Arrow; le altre codifiche sono transcodificate
+            encoding="utf8" if dialect.encoding.startswith("utf-8") else dialect.encoding,
+        ),
+        parse_options=pacsv.ParseOptions(
+            delimiter=dialect.delimiter, quote_char=dialect.quotechar, invalid_row_handler=bad_rows.arrow_handler
+        ),
+        convert_options=pacsv.ConvertOptions(
+            include_columns=list(columns) if columns is not None else None,
+            # tutto come stringa: nessuna inferenza di tipo, l'export riporta il testo originale
+            column_types={name: pa.string() for name in columns} if columns is not None else None,
+            strings_can_be_null=True,
+        ),
+    )
+    if columns is None:
+        table = table.cast(pa.schema([(name, pa.string()) for name in table.column_names]))
+    return table.to_pandas(types_mapper=pd.ArrowDtype)
+
+
+def _read_pandas(
+    source: Union[str, BinaryIO],
+    dialect: CsvDialect,
+    names: List[str],
+    columns: Optional[Sequence[str]],
+    errors: str,
+    bad_rows: BadRows,
+) -> pd.DataFrame:
+    df = bad_rows.pandas_call(
+        pd.read_csv,
+        source,
+        sep=dialect.delimiter,
+        quotechar=dialect.quotechar,
+        encoding=dialect.encoding,
+        encoding_errors=errors,
+        skiprows=dialect.header_row,
+        header=0,
+        names=names,
+        usecols=list(columns) if columns is not None else None,
+        dtype="string",
+        on_bad_lines="warn",
+    )
+    return df.reset_index(drop=True)
+
+
+def read_csv(
+    source: Union[str, BinaryIO], dialect: CsvDialect, columns: Optional[Sequence[str]] = None
+) -> Tuple[pd.DataFrame, CsvDialect]:
+    """
+    Parsing unico con il dialetto dato. columns: solo queste colonne (proiezione), None = tutte.
+    L'indice è la posizione della riga nel file (0..n-1), stabile qualunque sia la proiezione.
+    Se l'encoding del campione non regge sul file intero si riprova con i candidati successivi
+    (parse_encodings); solo se nessuno regge i byte non validi vengono sostituiti.
+    Le righe malformate si saltano e si contano (skipped_rows); un CSV che non si riesce
+    comunque a leggere (es. virgolette mai chiuse) solleva pandas.errors.ParserError.
+    Colonne con i nomi resi univoci come in pandas (vedi unique_names).
+    Ritorna anche il dialetto effettivo (encoding usato, replaced, skipped_rows).
+    """
+    names = header_columns(read_sample(source), dialect)
+    for encoding in parse_encodings(dialect):
+        attempt = dialect._replace(encoding=encoding)
+        if pacsv is not None:
+            if not isinstance(source, str):
+                source.seek(0)
+            bad_rows = BadRows()
+            try:
+                df = _read_arrow(source, attempt, names, columns, bad_rows)
+                return df, attempt._replace(skipped_rows=bad_rows.count)
+            except (pa.ArrowInvalid, UnicodeDecodeError):
+                pass  # byte fuori encoding, o CSV che il parser di Arrow non accetta: si prova pandas
+        if not isinstance(source, str):
+            source.seek(0)
+        bad_rows = BadRows()
+        try:
+            df = _read_pandas(source, attempt, names, columns, "strict", bad_rows)
+            return df, attempt._replace(skipped_rows=bad_rows.count)
+        except UnicodeDecodeError:
+            continue
+
+    if not isinstance(source, str):
+        source.seek(0)
+    bad_rows = BadRows()
+    df = _read_pandas(source, dialect, names, columns, "replace", bad_rows)
+    return df, dialect._replace(replaced=True, skipped_rows=bad_rows.count)
+
+
+def load_csv(source: Union[str, BinaryIO]) -> Tuple[pd.DataFrame, CsvDialect]:
+    """
+    Sniffing sui primi SNIFF_BYTES e parsing unico di tutte le colonne. source: percorso o file binario.
+    Il dialetto ritornato è quello effettivo del parsing (vedi read_csv).
+    """
+    dialect = sniff_csv(read_sample(source))
+    return read_csv(source, dialect)
+
+
+# -----------------------------
+# Store colonnare su disco (Arrow IPC, memory-mapped)
+# -----------------------------
+# righe per blocco nella conversione e nell'export
+BATCH_ROWS = 64 * 1024
+
+
+def _arrow_batches(source: Union[str, BinaryIO], dialect: CsvDialect, schema, bad_rows: BadRows):
+    reader = pacsv.open_csv(
+        source,
+        read_options=pacsv.ReadOptions(
+            skip_rows=dialect.header_row + 1,
+            column_names=schema.names,
+            encoding="utf8" if dialect.encoding.startswith("utf-8") else dialect.encoding,
+            block_size=4 * 1024 * 1024,
+        ),
+        parse_options=pacsv.ParseOptions(
+            delimiter=dialect.delimiter, quote_char=dialect.quotechar, invalid_row_handler=bad_rows.arrow_handler
+        ),
+        convert_options=pacsv.ConvertOptions(
+            column_types={name: pa.string() for name in schema.names}, strings_can_be_null=True
+        ),
+    )
+    yield from reader
+
+
+def _pandas_batches(source: Union[str, BinaryIO], dialect: CsvDialect, schema, bad_rows: BadRows):
+    reader = pd.read_csv(
+        source,
+        sep=dialect.delimiter,
+        quotechar=dialect.quotechar,
+        encoding=dialect.encoding,
+        encoding_errors="replace" if dialect.replaced else "strict",
+        skiprows=dialect.header_row,
+        header=0,
+        names=schema.names,
+        dtype="string",
+        chunksize=BATCH_ROWS,
+        on_bad_lines="warn",
+    )
+    with reader:
+        while True:
+            chunk = bad_rows.pandas_call(next, reader, None)
+            if chunk is None:
+                return
+            yield pa.RecordBatch.from_pandas(chunk, schema=schema, preserve_index=False)
+
+
+def convert_to_arrow(
+    source: Union[str, BinaryIO], dialect: CsvDialect, columns: List[str], dest: str
+) -> CsvDialect:
+    """
+    Converte il CSV in un file Arrow IPC a blocchi, senza mai avere l'intero file in memoria.
+    Scrive su un file temporaneo e lo rinomina: un file .arrow esistente è sempre completo.
+    Encoding come in read_csv: i candidati in ordine, la sostituzione dei byte solo come ultima
+    risorsa. Le righe malformate si saltano e si contano (skipped_rows); un CSV comunque
+    illeggibile solleva pandas.errors.ParserError.
+    Il dialetto effettivo, ritornato, resta anche nei metadati del file (ColumnStore).
+    """
+    if pa is None:
+        raise ImportError("Lo store colonnare richiede pyarrow (pip install pyarrow)")
+    schema = pa.schema([(name, pa.string()) for name in columns])
+    tmp = dest + ".tmp"
+    os.makedirs(os.path.dirname(dest) or ".", exist_ok=True)
+    attempts = [(dialect._replace(encoding=e), batches) for e in parse_encodings(dialect)
+                for batches in (_arrow_batches, _pandas_batches)]
+    attempts.append((dialect._replace(replaced=True), _pandas_batches))
+    for attempt, batches in attempts:
+        if not isinstance(source, str):
+            source.seek(0)
+        metadata = {"encoding": attempt.encoding, "replaced": "1" if attempt.replaced else "0"}
+        bad_rows = BadRows()
+        try:
+            with pa.OSFile(tmp, "wb") as sink, pa.ipc.new_file(sink, schema.with_metadata(metadata)) as writer:
+                for batch in batches(source, attempt, schema, bad_rows):
+                    writer.write_batch(batch)
+                # il conteggio si conosce solo alla fine: un blocco vuoto finale lo porta nei metadati
+                writer.write_batch(
+                    pa.RecordBatch.from_pylist([], schema=schema), custom_metadata={"skipped_rows": str(bad_rows.count)}
+                )
+            attempt = attempt._replace(skipped_rows=bad_rows.count)
+            break
+        except (pa.ArrowInvalid, UnicodeDecodeError):
+            # byte fuori encoding dopo il campione (o CSV che Arrow non accetta): tentativo successivo
+            if attempt.replaced:
+                raise
+    os.replace(tmp, dest)
+    return attempt
+
+
+def prune_files(directory: str, max_bytes: int, max_age: float, keep: Sequence[str] = ()) -> int:
+    """
+    Cache su disco a scadenza: elimina i file non usati (mtime) da più di max_age secondi, poi
+    i meno recenti finché il totale non sta in max_bytes. keep: percorsi in uso, mai eliminati;
+    i .tmp (scritture in corso) solo per età.
+    Ritorna i byte liberati.
+    """
+    keep = {os.path.abspath(p) for p in keep}
+    try:
+        names = os.listdir(directory)
+    except FileNotFoundError:
+        return 0
+    files = []
+    for name in names:
+        path = os.path.join(directory, name)
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            continue  # eliminato nel frattempo da un altro processo
+        files.append((st.st_mtime, st.st_size, path))
+    files.sort()
+    now = time.time()
+    total = sum(size for _, size, _ in files)
+    freed = 0
+    for mtime, size, path in files:
+        expired = now - mtime > max_age
+        # .tmp: scrittura in corso (o interrotta): solo per età
+        if os.path.abspath(path) in keep or (path.endswith(".tmp") and not expired):
+            continue
+        if total <= max_bytes and not expired:
+            continue
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        total -= size
+        freed += size
+    return freed
+
+
+class ColumnStore:
+    """
+    File Arrow IPC aperto in memory map: le colonne non occupano memoria del processo
+    finché non vengono lette e la cache di pagina del sistema è condivisa tra sessioni.
+    L'indice dei DataFrame restituiti è la posizione della riga nel file.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        reader = pa.ipc.open_file(pa.memory_map(path, "r"))
+        self.table = reader.read_all()
+        metadata = self.table.schema.metadata or {}
+        # encoding effettivo della conversione (None per file scritti prima che venisse salvato)
+        self.encoding: Optional[str] = metadata[b"encoding"].decode() if b"encoding" in metadata else None
+        self.replaced = metadata.get(b"replaced") == b"1"
+        # righe malformate saltate nella conversione: metadati dell'ultimo blocco (0 se assenti)
+        last = reader.get_batch_with_custom_metadata(reader.num_record_batches - 1) if reader.num_record_batches else None
+        self.skipped_rows = int((last.custom_metadata or {}).get(b"skipped_rows", 0)) if last else 0
+
+    @property
+    def num_rows(self) -> int:
+        return self.table.num_rows
+
+    @property
+    def column_names(self) -> List[str]:
+        return self.table.column_names
+
+    def columns(self, names: Sequence[str]) -> pd.DataFrame:
+        """Colonne intere (zero-copy: i dati restano nel file mappato)."""
+        return self.table.select(list(names)).to_pandas(types_mapper=pd.ArrowDtype)
+
+    def rows(self, start: int, stop: int, names: Optional[Sequence[str]] = None) -> pd.DataFrame:
+        """Solo le righe [start, stop), per la pagina corrente."""
+        table = self.table.slice(start, max(0, stop - start))
+        if names is not None:
+            table = table.select(list(names))
+        df = table.to_pandas(types_mapper=pd.ArrowDtype)
+        df.index = pd.RangeIndex(start, start + len(df))
+        return df
+
+    def take(self, row_ids: Sequence[int], names: Optional[Sequence[str]] = None) -> pd.DataFrame:
+        """Righe in posizioni arbitrarie (es. la coda di triage), nell'ordine dato."""
+        table = self.table if names is None else self.table.select(list(names))
+        df = table.take(pa.array(row_ids, type=pa.int64())).to_pandas(types_mapper=pd.ArrowDtype)
+        df.index = pd.Index(row_ids)
+        return df
+
+    def iter_frames(self, batch_rows: int = BATCH_ROWS) -> Iterator[pd.DataFrame]:
+        """Tutte le colonne, a blocchi di batch_rows righe (per l'export)."""
+        for start in range(0, self.num_rows, batch_rows):
+            yield self.rows(start, min(self.num_rows, start + batch_rows))
+
@@ -0,0 +1,169 @@
+"""
+Abbinamenti molti-a-molti, senza dipendenze da Streamlit: la colonna immagini Amazon e la
+colonna immagini Grossista come due cataloghi separati. Per ogni immagine Amazon si cercano
+le k immagini del grossista più simili in tutto il file, non solo quella sulla stessa riga.
+
+Il confronto tutti-contro-tutti (N·M) non è interattivo a 100k x 100k: HashIndex usa il
+multi-index hashing sui 192 bit impacchettati degli hash percettivi. I bit sono divisi in
+BANDS bande da 16 bit, ognuna con una tabella a indirizzamento diretto (65536 chiavi).
+Multi-probe: per ogni banda si leggono la chiave della query e le 16 chiavi a un bit di
+distanza, quindi basta una banda con al più un bit diverso perché un'immagine sia candidata.
+La classifica finale usa la distanza di Hamming esatta.
+
+Recall@1 misurata su hash casuali con bit invertiti a caso (100k x 100k):
+punteggio 90 (20 bit) ~1.00, 84 (30 bit) ~0.99, 79 (40 bit) ~0.83, 74 (50 bit) ~0.46;
+ricerca completa ~10 s.
+Sotto ~80 i suggerimenti possono mancare: MIN_RELIABLE_SCORE lo dichiara nell'app.
+"""
+from typing import List, Tuple
+
+import numpy as np
+
+from similarity import HASH_BYTES, distance_scores, packed_distances
+
+# bande da 16 bit (2 byte): chiavi uint16, tabelle a indirizzamento diretto
+BANDS = HASH_BYTES // 2
+KEYS = 1 << 16
+# chiavi lette per banda: la chiave stessa e quelle a distanza 1
+PROBES = np.array([0] + [1 << bit for bit in range(16)], dtype=np.uint16)
+# bucket più grandi (es. sfondo bianco uniforme) non distinguono nulla: si saltano
+MAX_BUCKET = 256
+# immagini Amazon per blocco di ricerca: limita la memoria delle coppie candidate
+QUERY_CHUNK = 2048
+# suggerimenti calcolati per riga
+TOP_K = 5
+# punteggio sopra il quale la ricerca trova quasi sempre l'immagine migliore (recall >= ~0.8)
+MIN_RELIABLE_SCORE = 80
+
+
+class HashIndex:
+    """Indice multi-banda su hash impacchettati (m, 24): per ogni banda, permutazione ordinata e bucket."""
+
+    def __init__(self, hashes: np.ndarray):
+        self.hashes = np.ascontiguousarray(hashes, dtype=np.uint8)
+        keys = self.hashes.view(np.uint16)  # (m, BANDS)
+        self._order = np.ascontiguousarray(np.argsort(keys, axis=0, kind="stable").T)
+        # bucket della chiave k nella banda b: _order[b, _starts[b, k]:_starts[b, k] + _counts[b, k]]
+        self._counts = np.stack([np.bincount(keys[:, b], minlength=KEYS) for b in range(BANDS)])
+        self._starts = np.cumsum(self._counts, axis=1) - self._counts
+
+    def __len__(self) -> int:
+        return len(self.hashes)
+
+    def candidates(self, queries: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """Coppie distinte (query, elemento) con almeno una banda a distanza <= 1, ordinate per query."""
+        keys = np.ascontiguousarray(queries, dtype=np.uint8).view(np.uint16)
+        query_of_probe = np.repeat(np.arange(len(keys)), len(PROBES))
+        parts: List[np.ndarray] = []
+        for band in range(BANDS):
+            probes = (keys[:, band, None] ^ PROBES).ravel()
+            lo = self._starts[band][probes]
+            counts = self._counts[band][probes]
+            counts[counts > MAX_BUCKET] = 0
+            total = int(counts.sum())
+            if not total:
+                continue
+            # posizioni lo..lo+count-1 di ogni probe, concatenate senza loop Python
+            starts = np.cumsum(counts) - counts
+            pos = np.arange(total) - np.repeat(starts - lo, counts)
+            parts.append(np.repeat(query_of_probe, counts) * len(self) + self._order[band][pos])
+        if not parts:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+        # una coppia trovata da più bande/probe conta una volta (sort + confronto col precedente)
+        pairs = np.sort(np.concatenate(parts))
+        pairs = pairs[np.r_[True, pairs[1:] != pairs[:-1]]]
+        return pairs // len(self), pairs % len(self)
+
+    def top_k(self, queries: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Per ogni query, i k elementi più simili tra i candidati: (indici (n, k), punteggi (n, k)),
+        dal più simile; -1 e NaN dove i candidati sono meno di k.
+        """
+        ids = np.full((len(queries), k), -1, dtype=np.int64)
+        scores = np.full((len(queries), k), np.nan, dtype=np.float32)
+        n_bits = self.hashes.shape[1] * 8
+        for first in range(0, len(queries), QUERY_CHUNK):
+            chunk = queries[first:first + QUERY_CHUNK]
+            qi, ci = self.candidates(chunk)
+            if not len(qi):
+                continue
+            dist = packed_distances(chunk[qi], self.hashes[ci])
+            # per query, dalla distanza minore: una sola chiave intera (query, distanza)
+            order = np.argsort(qi * (n_bits + 1) + dist, kind="stable")
+            qi, ci, dist = qi[order], ci[order], dist[order]
+            group_start = np.flatnonzero(np.r_[True, qi[1:] != qi[:-1]])
+            rank = np.arange(len(qi)) - np.repeat(group_start, np.diff(np.r_[group_start, len(qi)]))
+            keep = rank < k
+            ids[first + qi[keep], rank[keep]] = ci[keep]
+            scores[first + qi[keep], rank[keep]] = distance_scores(dist[keep], n_bits)
+        return ids, scores
+
+
+def match_catalogs(
+    left_valid: np.ndarray, left_hashes: np.ndarray, right_valid: np.ndarray, right_hashes: np.ndarray, k: int
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Per ogni riga, le k righe dell'altro catalogo con l'immagine più simile alla propria
+    immagine di sinistra, esclusa l'immagine già abbinata sulla riga: (righe (n, k), punteggi (n, k)),
+    -1 e NaN dove mancano. Immagini identiche (stessi hash) si indicizzano e cercano una volta
+    sola; ogni immagine di destra è rappresentata dalla prima riga che la usa.
+    """
+    n = len(left_hashes)
+    rows = np.full((n, k), -1, dtype=np.int64)
+    scores = np.full((n, k), np.nan, dtype=np.float32)
+    left_ids, right_ids = np.flatnonzero(left_valid), np.flatnonzero(right_valid)
+    if not len(left_ids) or not len(right_ids):
+        return rows, scores
+
+    right_unique, right_first, right_inverse = np.unique(
+        right_hashes[right_ids], axis=0, return_index=True, return_inverse=True
+    )
+    representative = right_ids[right_first]
+    own = np.full(n, -1, dtype=np.int64)
+    own[right_ids] = right_inverse.reshape(-1)
+    left_unique, left_inverse = np.unique(left_hashes[left_ids], axis=0, return_inverse=True)
+
+    # k + 1: l'immagine già sulla riga può essere tra i risultati e va tolta
+    ids, found = HashIndex(right_unique).top_k(left_unique, k + 1)
+    ids, found = ids[left_inverse.reshape(-1)], found[left_inverse.reshape(-1)]
+    mine = ids == own[left_ids][:, None]
+    ids[mine], found[mine] = -1, np.nan
+    # compatta a sinistra i risultati rimasti, mantenendo l'ordine
+    order = np.argsort(ids < 0, axis=1, kind="stable")[:, :k]
+    ids, found = np.take_along_axis(ids, order, axis=1), np.take_along_axis(found, order, axis=1)
+    rows[left_ids] = np.where(ids >= 0, representative[np.maximum(ids, 0)], -1)
+    scores[left_ids] = found
+    return rows, scores
+
+
+# -----------------------------
+# Suggerimenti di riabbinamento per riga
+# -----------------------------
+class RepairSuggestions:
+    """Per ogni riga, le righe del grossista con l'immagine più simile a quella Amazon (TOP_K, dal migliore)."""
+
+    def __init__(self, n_rows: int, k: int = TOP_K):
+        self.rows = np.full((n_rows, k), -1, dtype=np.int64)
+        self.scores = np.full((n_rows, k), np.nan, dtype=np.float32)
+        self.ready = False
+
+    def update(self, rows: np.ndarray, scores: np.ndarray) -> None:
+        """rows, scores: risultati di match_catalogs per tutto il file."""
+        self.rows[:], self.scores[:] = rows, scores
+        self.ready = True
+
+    def gains(self, current: np.ndarray) -> np.ndarray:
+        """Miglioramento del primo suggerimento sulla coppia attuale (senza punteggio = 0); NaN se non c'è."""
+        return self.scores[:, 0] - np.nan_to_num(current, nan=0.0)
+
+    def queue(self, current: np.ndarray, min_gain: float) -> np.ndarray:
+        """Righe con un abbinamento migliore di almeno min_gain punti, dal miglioramento più grande."""
+        gains = self.gains(current)
+        rows = np.flatnonzero(gains >= min_gain)
+        return rows[np.argsort(-gains[rows], kind="stable")]
+
+    def for_row(self, row_id: int, k: int) -> List[Tuple[int, float]]:
+        """(riga del grossista, punteggio) dei primi k suggerimenti della riga."""
+        return [
+            (int(r), float(s)) for r, s in zip(self.rows[row_id, :k], self.scores[row_id, :k]) if r >= 0
+        ]
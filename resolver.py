@@ -0,0 +1,585 @@
+"""
+Risoluzione delle immagini Amazon e download, senza dipendenze da Streamlit:
+usato da app.py (con le cache st.cache_*) e dalla CLI bulk_resolve.py.
+"""
+import codecs
+import os
+import re
+import html as htmllib
+import sqlite3
+import time
+import threading
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Callable, Optional, Dict, Iterator, Tuple, NamedTuple, List
+from urllib.parse import urlsplit, urlunsplit
+
+import pandas as pd
+import requests
+
+
+# -----------------------------
+# Proxy (IPRoyal) via ENV / Secrets e sessione HTTP
+# -----------------------------
+def get_proxy_config() -> Optional[Dict[str, str]]:
+    """
+    Legge proxy da variabili ambiente.
+    Esempio:
+      PROXY_HOST=...
+      PROXY_PORT=...
+      PROXY_USER=...
+      PROXY_PASS=...
+    Restituisce dict compatibile con requests: {"http": "...", "https": "..."}
+    """
+    host = os.getenv("PROXY_HOST", "").strip()
+    port = os.getenv("PROXY_PORT", "").strip()
+    user = os.getenv("PROXY_USER", "").strip()
+    password = os.getenv("PROXY_PASS", "").strip()
+
+    if not host or not port:
+        return None
+
+    if user and password:
+        proxy_url = f"http://{user}:{password}@{host}:{port}"
+    else:
+        proxy_url = f"http://{host}:{port}"
+
+    return {"http": proxy_url, "https": proxy_url}
+
+
+def get_timeout() -> Tuple[float, float]:
+    # (connect timeout, read timeout)
+    return (5.0, 12.0)
+
+
+# Limite massimo di download paralleli (anche dimensione del pool di connessioni)
+MAX_WORKERS = 32
+
+
+def build_session() -> requests.Session:
+    s = requests.Session()
+    # pool di connessioni abbastanza grande per i worker paralleli
+    adapter = requests.adapters.HTTPAdapter(pool_connections=MAX_WORKERS, pool_maxsize=MAX_WORKERS)
+    s.mount("http://", adapter)
+    s.mount("https://", adapter)
+    # User-Agent “normale” (aiuta a ricevere HTML standard)
+    s.headers.update(
+        {
+            "User-Agent": (
+                "Mozilla/5.0 (Windows NT 10.0; Win64; x64) "
+                "AppleWebKit/537.36 (KHTML, like Gecko) "
+                "Chrome/123.0.0.0 Safari/537.36"
+            ),
+            "Accept-Language": "it-IT,it;q=0.9,en-US;q=0.8,en;q=0.7",
+        }
+    )
+    return s
+
+
+# -----------------------------
+# Rate limit per host (token bucket)
+# -----------------------------
+AMAZON_IMAGE_HOSTS = ("media-amazon.com", "images-amazon.com", "ssl-images-amazon.com")
+
+# classi di host → richieste/secondo di default (per singolo host)
+DEFAULT_HOST_RATES: Dict[str, float] = {
+    "amazon": 2.0,       # pagine prodotto amazon.it/.com/...
+    "amazon_img": 10.0,  # CDN immagini Amazon
+    "grossista": 5.0,    # CDN/siti dei grossisti
+}
+
+
+def host_class(host: str) -> str:
+    if host.endswith(AMAZON_IMAGE_HOSTS):
+        return "amazon_img"
+    if host.startswith("amazon.") or ".amazon." in host:
+        return "amazon"
+    return "grossista"
+
+
+class HostRateLimiter:
+    """
+    Token bucket separato per ogni host, thread-safe.
+    Va chiamato solo prima di una richiesta di rete reale (mai sui cache hit):
+    acquire() attende il tempo necessario e restituisce i secondi di attesa.
+    Un rate <= 0 disattiva il limite per quella classe di host.
+    """
+
+    def __init__(self, rates: Dict[str, float]):
+        self._lock = threading.Lock()
+        self._rates = dict(rates)
+        # host → (token disponibili, ultimo aggiornamento)
+        self._buckets: Dict[str, Tuple[float, float]] = {}
+
+    def configure(self, rates: Dict[str, float]) -> None:
+        with self._lock:
+            self._rates.update(rates)
+
+    def acquire(self, url: str) -> float:
+        host = (urlsplit(url).hostname or "").lower()
+        cls = host_class(host)
+        meter = _THROTTLE_METER.get()
+        with self._lock:
+            rate = self._rates.get(cls, 0.0)
+            if rate <= 0:
+                if meter is not None:
+                    meter.add(cls, 0.0)
+                return 0.0
+            burst = max(1.0, rate)
+            now = time.monotonic()
+            tokens, last = self._buckets.get(host, (burst, now))
+            tokens = min(burst, tokens + (now - last) * rate)
+            # prenota il token: con token < 0 i thread successivi si mettono in fila
+            tokens -= 1.0
+            self._buckets[host] = (tokens, now)
+            wait = -tokens / rate if tokens < 0 else 0.0
+        if wait > 0:
+            time.sleep(wait)
+        if meter is not None:
+            meter.add(cls, wait)
+        return wait
+
+
+class ThrottleMeter:
+    """
+    Richieste in rete e attese del rate limiter, per classe di host. Thread-safe.
+    waited somma le attese dei singoli thread; wall_waited() è il tempo reale in cui almeno
+    un thread era fermo sul limiter (le attese in parallelo si sovrappongono).
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.requests: Dict[str, int] = {}
+        self.waited: Dict[str, float] = {}
+        self._intervals: List[Tuple[float, float]] = []
+
+    def add(self, cls: str, wait: float) -> None:
+        end = time.monotonic()
+        with self._lock:
+            self.requests[cls] = self.requests.get(cls, 0) + 1
+            self.waited[cls] = self.waited.get(cls, 0.0) + wait
+            if wait > 0:
+                self._intervals.append((end - wait, end))
+
+    def wall_waited(self) -> float:
+        with self._lock:
+            intervals = sorted(self._intervals)
+        total, cur_start, cur_end = 0.0, None, None
+        for start, end in intervals:
+            if cur_end is None or start > cur_end:
+                if cur_end is not None:
+                    total += cur_end - cur_start
+                cur_start, cur_end = start, end
+            else:
+                cur_end = max(cur_end, end)
+        if cur_end is not None:
+            total += cur_end - cur_start
+        return total
+
+    def total_requests(self) -> int:
+        return sum(self.requests.values())
+
+
+_THROTTLE_METER: ContextVar[Optional[ThrottleMeter]] = ContextVar("throttle_meter", default=None)
+
+
+@contextmanager
+def measure_throttle() -> Iterator[ThrottleMeter]:
+    """
+    Misura il throttling delle richieste fatte nel blocco. Nei thread di un pool il meter arriva solo
+    se il task gira nel contesto del chiamante: pool.submit(contextvars.copy_context().run, fn, ...).
+    """
+    meter = ThrottleMeter()
+    token = _THROTTLE_METER.set(meter)
+    try:
+        yield meter
+    finally:
+        _THROTTLE_METER.reset(token)
+
+
+# -----------------------------
+# Cache persistente: URL Amazon → URL immagine (SQLite)
+# -----------------------------
+CACHE_DIR = os.getenv("MATCHER_CACHE_DIR", ".matcher_cache")
+IMAGE_STORE_PATH = os.path.join(CACHE_DIR, "amazon_images.sqlite")
+
+# TTL per stato: un'immagine trovata è stabile, un errore di rete va riprovato presto
+STORE_TTLS: Dict[str, float] = {
+    "ok": 30 * 24 * 60 * 60,
+    "not_found": 3 * 24 * 60 * 60,
+    "error": 60 * 60,
+}
+
+
+# /dp/ASIN, /gp/product/ASIN, /gp/aw/d/ASIN (mobile), /exec/obidos/ASIN/ASIN, /o/ASIN/ASIN
+ASIN_PATH_RE = re.compile(
+    r"/(?:dp|gp/product|gp/aw/d|exec/obidos/asin|o/asin)/([a-z0-9]{10})(?:[/?#]|$)", re.IGNORECASE
+)
+
+
+def parse_amazon_url(url: str) -> Optional[Tuple[str, str]]:
+    """(marketplace, ASIN) per un URL prodotto Amazon, es. ("amazon.it", "B0XXXXXXXX"); None se non riconosciuto."""
+    parts = urlsplit(url.strip())
+    host = (parts.hostname or "").lower()
+    if host_class(host) != "amazon":
+        return None
+    m = ASIN_PATH_RE.search(parts.path)
+    if not m:
+        return None
+    marketplace = host.split("amazon.", 1)[1]
+    return "amazon." + marketplace, m.group(1).upper()
+
+
+def canonical_amazon_url(url: str) -> str:
+    """
+    Chiave stabile per un URL Amazon: https://www.<marketplace>/dp/<ASIN>, indipendente da slug,
+    /gp/product, ref= e query string. Se l'ASIN non si trova: host minuscolo, senza fragment né /ref=.
+    """
+    parsed = parse_amazon_url(url)
+    if parsed:
+        marketplace, asin = parsed
+        return f"https://www.{marketplace}/dp/{asin}"
+    parts = urlsplit(url.strip())
+    path = parts.path.split("/ref=")[0].rstrip("/")
+    return urlunsplit((parts.scheme.lower() or "https", parts.netloc.lower(), path, parts.query, ""))
+
+
+class ImageUrlStore:
+    """
+    Cache su disco (SQLite, WAL) che sopravvive a riavvii e redeploy.
+    Ogni voce: url canonico → url immagine, stato, istante del fetch e TTL propria.
+    """
+
+    def __init__(self, path: str):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS amazon_image_urls (
+                url TEXT PRIMARY KEY,
+                image_url TEXT,
+                status TEXT NOT NULL,
+                fetched_at REAL NOT NULL,
+                ttl REAL NOT NULL
+            )
+            """
+        )
+
+    def get(self, url: str) -> Optional[Tuple[str, Optional[str]]]:
+        """(stato, url immagine) se la voce esiste e non è scaduta, altrimenti None."""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT status, image_url FROM amazon_image_urls WHERE url = ? AND fetched_at + ttl > ?",
+                (url, time.time()),
+            ).fetchone()
+        return (row[0], row[1]) if row else None
+
+    def put(self, url: str, image_url: Optional[str], status: str, ttl: Optional[float] = None) -> None:
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO amazon_image_urls VALUES (?, ?, ?, ?, ?)",
+                (url, image_url, status, time.time(), STORE_TTLS[status] if ttl is None else ttl),
+            )
+
+    def warm(self, pairs: pd.DataFrame, url_col: str, image_col: str) -> int:
+        """Importa coppie url Amazon → url immagine (es. da un export precedente). Ritorna le righe importate."""
+        valid = pairs[[url_col, image_col]].dropna()
+        now = time.time()
+        records = [
+            (canonical_amazon_url(str(u)), str(img).strip(), "ok", now, STORE_TTLS["ok"])
+            for u, img in valid.itertuples(index=False)
+            if str(u).strip() and str(img).strip()
+        ]
+        with self._lock:
+            self._conn.executemany("INSERT OR REPLACE INTO amazon_image_urls VALUES (?, ?, ?, ?, ?)", records)
+        return len(records)
+
+    def export(self) -> pd.DataFrame:
+        with self._lock:
+            return pd.read_sql_query(
+                "SELECT url, image_url, status, fetched_at, ttl FROM amazon_image_urls WHERE status = 'ok'",
+                self._conn,
+            )
+
+    def count_fresh(self, urls: List[str]) -> int:
+        """Quante delle chiavi indicate hanno una voce non scaduta."""
+        found = 0
+        now = time.time()
+        with self._lock:
+            for i in range(0, len(urls), 500):
+                chunk = urls[i:i + 500]
+                found += self._conn.execute(
+                    f"SELECT COUNT(*) FROM amazon_image_urls WHERE fetched_at + ttl > ? "
+                    f"AND url IN ({','.join('?' * len(chunk))})",
+                    (now, *chunk),
+                ).fetchone()[0]
+        return found
+
+    def count(self) -> int:
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM amazon_image_urls").fetchone()[0]
+
+
+# -----------------------------
+# Fetch pagina Amazon → og:image
+# -----------------------------
+class FetchError(Exception):
+    """Pagina non scaricabile: non va in cache (ci pensa lo store con TTL breve)."""
+
+
+# limite di HTML letto per pagina se il </head> non arriva mai
+MAX_HTML_BYTES = 1_500_000
+
+
+# tokenizer minimo, con le regole di html.parser che contano per i <meta>: commenti e
+# contenuto di <script>/<style> sono testo, i ">" tra virgolette non chiudono il tag
+_QUOTED_TAG_BODY = r"""(?:[^>"']|"[^"]*"|'[^']*')*"""
+HTML_TOKEN_RE = re.compile(
+    r"<!--.*?(?:-->|\Z)"
+    r"|<(script|style)\b" + _QUOTED_TAG_BODY + r">.*?(?:</\1\s*>|\Z)"
+    r"|<meta\b(" + _QUOTED_TAG_BODY + r")>"
+    r"|</?[a-zA-Z!?]" + _QUOTED_TAG_BODY + r">",
+    re.IGNORECASE | re.DOTALL,
+)
+# inizio di un tag: se non forma un token è un tag non ancora arrivato per intero
+TAG_START_RE = re.compile(r"</?[a-zA-Z!?]")
+ATTR_RE = re.compile(r"""([^\s"'>/=]+)(?:\s*=\s*(?:"([^"]*)"|'([^']*)'|([^\s"'>]+)))?""")
+
+
+def _meta_attrs(body: str) -> Dict[str, str]:
+    attrs: Dict[str, str] = {}
+    for name, dq, sq, bare in ATTR_RE.findall(body):
+        attrs[name.lower()] = htmllib.unescape(dq or sq or bare)
+    return attrs
+
+
+def meta_tags(html: str):
+    """Attributi (nomi minuscoli, valori unescaped) di ogni <meta> del documento, in ordine e su richiesta."""
+    for m in HTML_TOKEN_RE.finditer(html):
+        if m.group(2) is not None:
+            yield _meta_attrs(m.group(2))
+
+
+def extract_og_image(html: str) -> Optional[str]:
+    """
+    og:image, altrimenti twitter:image (conta il primo tag di ciascun tipo, come in BeautifulSoup.find).
+    Scansione a regex dei soli tag, senza albero DOM: si ferma al primo og:image, che nelle pagine
+    Amazon è nell'head; solo le pagine senza og:image vengono lette fino in fondo.
+    """
+    og_seen = False
+    twitter_image: Optional[str] = None
+    for attrs in meta_tags(html):
+        if not og_seen and attrs.get("property") == "og:image":
+            og_seen = True
+            og_image = attrs.get("content", "")
+            if og_image:
+                # solo spazi: come BeautifulSoup decide comunque questo tag (nessuna immagine)
+                return og_image.strip() or None
+        if twitter_image is None and attrs.get("name") == "twitter:image":
+            twitter_image = attrs.get("content", "").strip()
+        if og_seen and twitter_image is not None:
+            break
+    return twitter_image or None
+
+
+class HeadScanner:
+    """
+    Scansione incrementale dei tag della pagina mentre arriva, con lo stesso tokenizer di
+    extract_og_image: commenti, <script>/<style> e valori tra virgolette non fermano la lettura.
+    feed() dice quando il testo ricevuto basta: primo og:image con contenuto, o </head>.
+    """
+
+    def __init__(self):
+        self.text = ""
+        self._pos = 0
+        self._og_seen = False
+
+    def feed(self, text: str) -> bool:
+        self.text += text
+        for m in HTML_TOKEN_RE.finditer(self.text, self._pos):
+            # tag troncato prima di m (es. attributo tra virgolette non chiuso): m potrebbe esserne
+            # il contenuto, non un tag vero. Commento o script senza chiusura: possono continuare.
+            if TAG_START_RE.search(self.text, self._pos, m.start()) or m.end() == len(self.text):
+                return False
+            self._pos = m.end()
+            if m.group(2) is not None:
+                attrs = _meta_attrs(m.group(2))
+                if not self._og_seen and attrs.get("property") == "og:image":
+                    # il primo og:image decide (extract_og_image): se vuoto conta twitter:image, fino a </head>
+                    self._og_seen = True
+                    if attrs.get("content", "").strip():
+                        return True
+            elif m.group(0)[:6].lower() == "</head":
+                return True
+        return False
+
+
+def fetch_html(
+    url: str, session: requests.Session, proxies: Optional[Dict[str, str]], limiter: HostRateLimiter
+) -> Optional[str]:
+    """
+    Scarica la pagina in streaming e chiude la connessione appena HeadScanner dice che basta
+    (og:image trovato o </head> vero superato): a extract_og_image serve solo l'head e la banda
+    del proxy si paga.
+    """
+    try:
+        limiter.acquire(url)
+        with session.get(url, proxies=proxies, timeout=get_timeout(), allow_redirects=True, stream=True) as r:
+            if r.status_code >= 400:
+                return None
+
+            # Amazon può rispondere gzip/charset variabile → iter_content decomprime, il charset è negli header;
+            # decoder incrementale: un carattere multibyte può stare a cavallo di due chunk
+            decoder = codecs.getincrementaldecoder(r.encoding or "utf-8")(errors="replace")
+            scanner = HeadScanner()
+            size = 0
+            for chunk in r.iter_content(chunk_size=16 * 1024):
+                if not chunk:
+                    break
+                size += len(chunk)
+                if scanner.feed(decoder.decode(chunk)) or size > MAX_HTML_BYTES:
+                    break
+            return scanner.text + decoder.decode(b"", final=True)
+    except (requests.RequestException, LookupError):
+        return None
+
+
+# captcha / robot check: HTTP 200 ma nessun prodotto. Il form è nel body (spesso non letto, vedi
+# fetch_html); nell'head il titolo è solo "Amazon.it" (o manca), mai "Amazon.it: <prodotto>"
+CAPTCHA_FORM_RE = re.compile(r"/errors/validateCaptcha", re.IGNORECASE)
+TITLE_RE = re.compile(r"<title\b[^>]*>(.*?)</title\s*>", re.IGNORECASE | re.DOTALL)
+BOT_WALL_TITLE_RE = re.compile(r"\s*(?:amazon(?:\.[a-z]{2,3})+|robot check)?\s*", re.IGNORECASE)
+
+
+def is_bot_wall(html: str) -> bool:
+    """Pagina di blocco anti-bot al posto della pagina prodotto."""
+    if CAPTCHA_FORM_RE.search(html):
+        return True
+    title = TITLE_RE.search(html)
+    return title is None or BOT_WALL_TITLE_RE.fullmatch(htmllib.unescape(title.group(1))) is not None
+
+
+def fetch_og_image(
+    url: str, session: requests.Session, proxies: Optional[Dict[str, str]], limiter: HostRateLimiter
+) -> Tuple[str, Optional[str]]:
+    """
+    Scarica la pagina, estrae og:image e scarta subito l'HTML: restituisce solo
+    (stato, url immagine), mai la pagina intera. FetchError se la pagina non arriva o se
+    al suo posto arriva un captcha: va riprovata presto, non registrata come not_found.
+    """
+    html = fetch_html(url, session, proxies, limiter)
+    if not html:
+        raise FetchError(url)
+    image_url = extract_og_image(html)
+    if not image_url and is_bot_wall(html):
+        raise FetchError(url)
+    return ("ok" if image_url else "not_found"), image_url
+
+
+def fetch_image_bytes(
+    url: str, session: requests.Session, proxies: Optional[Dict[str, str]], limiter: HostRateLimiter
+) -> Optional[bytes]:
+    try:
+        limiter.acquire(url)
+        r = session.get(url, proxies=proxies, timeout=get_timeout(), stream=True)
+        if r.status_code >= 400:
+            return None
+
+        # limita dimensione per evitare bombe di memoria
+        max_bytes = 3_500_000  # ~3.5MB
+        data = bytearray()
+        for chunk in r.iter_content(chunk_size=64 * 1024):
+            if not chunk:
+                break
+            data.extend(chunk)
+            if len(data) > max_bytes:
+                break
+        return bytes(data)
+    except requests.RequestException:
+        return None
+
+
+def lookup_image_url(
+    key: str, store: ImageUrlStore, resolve: Callable[[str], Tuple[str, Optional[str]]]
+) -> Optional[str]:
+    """
+    URL og:image per una chiave canonica (vedi canonical_amazon_url):
+    prima la cache persistente, poi resolve(key). L'esito finisce nello store,
+    che fa anche da checkpoint per le risoluzioni bulk.
+    """
+    cached = store.get(key)
+    if cached is not None:
+        return cached[1]
+
+    try:
+        status, image_url = resolve(key)
+    except FetchError:
+        store.put(key, None, "error")
+        return None
+
+    store.put(key, image_url, status)
+    return image_url
+
+
+# -----------------------------
+# Piano download: deduplica su tutto il file
+# -----------------------------
+class DownloadPlan(NamedTuple):
+    rows: pd.DataFrame       # per riga: amazon_key, amazon_image, gross_image (NA se assenti)
+    amazon_refs: pd.Series   # chiave Amazon canonica → numero di righe che la usano
+    image_refs: pd.Series    # URL immagine già noto (grossista o colonna Amazon) → numero di righe
+    amazon_cached: int       # chiavi Amazon già nella cache persistente al momento del piano
+    amazon_raw_urls: int     # URL Amazon distinti così come scritti nel file (prima della chiave ASIN)
+
+    def network_ops(self) -> int:
+        # ogni pagina Amazon: fetch (se non in cache) + download dell'immagine trovata
+        return 2 * len(self.amazon_refs) - self.amazon_cached + len(self.image_refs)
+
+    def saved_fetches(self) -> int:
+        """Fetch evitati dalla chiave canonica: URL diversi della stessa pagina prodotto."""
+        return self.amazon_raw_urls - len(self.amazon_refs)
+
+
+def _clean_urls(values: pd.Series) -> pd.Series:
+    values = values.astype("string").str.strip()
+    return values.mask(values == "")
+
+
+def build_download_plan(
+    df: pd.DataFrame,
+    amazon_url_col: str,
+    amazon_img_col: Optional[str],
+    grossista_img_col: Optional[str],
+    store: ImageUrlStore,
+) -> DownloadPlan:
+    """
+    Passata unica sul file: chiavi Amazon canoniche e URL immagine per riga, più i conteggi
+    degli elementi unici. Ogni elemento unico si scarica una volta sola e il risultato
+    viene rimappato su tutte le righe che lo usano.
+    """
+    if amazon_img_col:
+        direct = _clean_urls(df[amazon_img_col])
+    else:
+        direct = pd.Series(pd.NA, index=df.index, dtype="string")
+
+    # la pagina Amazon serve solo dove manca l'URL immagine diretto
+    raw = _clean_urls(df[amazon_url_col]).where(direct.isna())
+    canonical = {url: canonical_amazon_url(url) for url in raw.dropna().unique()}
+    keys = raw.map(canonical).astype("string")
+
+    if grossista_img_col:
+        gross = _clean_urls(df[grossista_img_col])
+    else:
+        gross = pd.Series(pd.NA, index=df.index, dtype="string")
+
+    amazon_refs = keys.value_counts()
+    return DownloadPlan(
+        rows=pd.DataFrame({"amazon_key": keys, "amazon_image": direct, "gross_image": gross}),
+        amazon_refs=amazon_refs,
+        image_refs=pd.concat([direct, gross]).value_counts(),
+        amazon_cached=store.count_fresh(amazon_refs.index.tolist()),
+        amazon_raw_urls=len(canonical),
+    )
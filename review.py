@@ -0,0 +1,361 @@
+"""
+Stato della revisione MATCH, senza dipendenze da Streamlit.
+
+Una decisione per riga in un array int8 lungo quanto il file (1 byte per riga):
+"non ancora vista" resta distinta da "vista, non è un match".
+Ogni decisione è anche accodata a un journal su disco (SQLite, WAL), per file:
+refresh del browser, websocket caduti e redeploy non perdono il lavoro fatto.
+Il journal è condiviso: più revisori sullo stesso file vedono le decisioni degli altri
+(sync) e si dividono le pagine con lease a scadenza.
+"""
+import os
+import sqlite3
+import threading
+import time
+from typing import Dict, List, Optional, Sequence
+
+import numpy as np
+
+from resolver import CACHE_DIR
+
+REVIEW_JOURNAL_PATH = os.path.join(CACHE_DIR, "reviews.sqlite")
+
+# stati di una riga
+UNREVIEWED = 0
+MATCH = 1
+NO_MATCH = 2
+# row_id dei record di reset: azzerano tutte le decisioni precedenti del file
+# (scritti dalle versioni precedenti; il reset ora annulla solo le decisioni del revisore)
+RESET_ROW = -1
+# durata di un lease senza attività del revisore
+LEASE_TTL = 15 * 60
+# firma delle decisioni del triage automatico: TRIAGE_REVIEWER + revisore che ha applicato le soglie
+# (i journal precedenti hanno solo "triage-auto")
+TRIAGE_REVIEWER = "triage-auto"
+
+
+def triage_signature(reviewer: str) -> str:
+    return f"{TRIAGE_REVIEWER}:{reviewer}"
+
+
+class ReviewJournal:
+    """
+    Journal append-only delle decisioni, chiave (hash del file, riga), condiviso da tutti i
+    revisori dello stesso file. Ogni blocco di decisioni (un click, un triage, un reset) è una
+    transazione con commit sincrono: un fsync, meno di un millisecondo in WAL.
+    Ogni sessione legge solo le voci successive all'ultima vista (seq).
+    Contiene anche i lease: intervalli di righe assegnati a un revisore per LEASE_TTL secondi.
+    """
+
+    def __init__(self, path: str):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        # FULL: la decisione è su disco prima che il click sia confermato
+        self._conn.execute("PRAGMA synchronous=FULL")
+        self._conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS match_journal (
+                seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                file_hash TEXT NOT NULL,
+                row_id INTEGER NOT NULL,
+                state INTEGER NOT NULL,
+                decided_at REAL NOT NULL,
+                reviewer TEXT
+            )
+            """
+        )
+        # journal creati prima dei revisori multipli
+        if "reviewer" not in {r[1] for r in self._conn.execute("PRAGMA table_info(match_journal)")}:
+            self._conn.execute("ALTER TABLE match_journal ADD COLUMN reviewer TEXT")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS match_journal_file ON match_journal (file_hash, seq)")
+        self._conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS review_leases (
+                file_hash TEXT NOT NULL,
+                reviewer TEXT NOT NULL,
+                start_row INTEGER NOT NULL,
+                end_row INTEGER NOT NULL,
+                expires_at REAL NOT NULL,
+                PRIMARY KEY (file_hash, reviewer)
+            )
+            """
+        )
+
+    def append_many(self, file_hash: str, row_ids, states, reviewer: Optional[str] = None) -> None:
+        now = time.time()
+        records = [(file_hash, int(r), int(s), now, reviewer) for r, s in zip(row_ids, states)]
+        with self._lock:
+            # una transazione per blocco: un solo fsync anche per 100k decisioni del triage
+            self._conn.execute("BEGIN")
+            try:
+                self._conn.executemany(
+                    "INSERT INTO match_journal (file_hash, row_id, state, decided_at, reviewer) VALUES (?, ?, ?, ?, ?)",
+                    records,
+                )
+                self._conn.execute("COMMIT")
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    def append(self, file_hash: str, row_id: int, state: int, reviewer: Optional[str] = None) -> None:
+        self.append_many(file_hash, [row_id], [state], reviewer)
+
+    def entries_since(self, file_hash: str, seq: int) -> np.ndarray:
+        """Voci (seq, row_id, stato) successive a seq, in ordine, come array NumPy (n, 3)."""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT seq, row_id, state FROM match_journal WHERE file_hash = ? AND seq > ? ORDER BY seq",
+                (file_hash, seq),
+            ).fetchall()
+        return np.array(rows, dtype=np.int64).reshape(-1, 3)
+
+    def conflicts(self, file_hash: str) -> List[int]:
+        """
+        Righe dove le decisioni in vigore di due o più revisori (l'ultima di ciascuno dopo
+        l'ultimo reset) sono diverse. Non contano un annullamento (UNREVIEWED: il revisore non
+        ha più un parere) né il triage automatico, che un revisore corregge apposta.
+        Vale l'ultima decisione (ordine del journal); l'elenco serve a ricontrollarle.
+        Legge tutto il journal del file: da chiamare su richiesta, non a ogni rerun.
+        """
+        with self._lock:
+            rows = self._conn.execute(
+                """
+                SELECT row_id FROM (
+                    -- SQLite: con MAX(seq) le colonne non aggregate vengono dalla riga più recente
+                    SELECT row_id, state, MAX(seq) FROM match_journal
+                    WHERE file_hash = ? AND row_id >= 0 AND reviewer IS NOT NULL AND reviewer NOT LIKE ?
+                    AND seq > COALESCE(
+                        (SELECT MAX(seq) FROM match_journal WHERE file_hash = ? AND row_id = ?), 0
+                    )
+                    GROUP BY row_id, reviewer
+                )
+                WHERE state != ?
+                GROUP BY row_id
+                HAVING COUNT(DISTINCT state) > 1
+                ORDER BY row_id
+                """,
+                (file_hash, TRIAGE_REVIEWER + "%", file_hash, RESET_ROW, UNREVIEWED),
+            ).fetchall()
+        return [r[0] for r in rows]
+
+    # -----------------------------
+    # Lease: un intervallo di righe per revisore, scade se non rinnovato
+    # -----------------------------
+    def claim(self, file_hash: str, reviewer: str, states: np.ndarray, page_size: int) -> Optional[int]:
+        """
+        Assegna al revisore la prossima pagina con righe non revisionate che non è in lease a un altro
+        (il lease precedente del revisore viene rilasciato). Si cerca dopo la pagina del lease
+        precedente, poi dall'inizio: la pagina appena lasciata torna solo se è l'unica libera.
+        Ritorna la riga iniziale, None se non ce ne sono.
+        """
+        pending = np.add.reduceat(states == UNREVIEWED, np.arange(0, len(states), page_size)) if len(states) else []
+        now = time.time()
+        with self._lock:
+            # IMMEDIATE: due processi non possono assegnarsi la stessa pagina
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                taken = self._conn.execute(
+                    "SELECT start_row, end_row FROM review_leases "
+                    "WHERE file_hash = ? AND reviewer != ? AND expires_at > ?",
+                    (file_hash, reviewer, now),
+                ).fetchall()
+                previous = self._conn.execute(
+                    "SELECT start_row FROM review_leases WHERE file_hash = ? AND reviewer = ?", (file_hash, reviewer)
+                ).fetchone()
+                pages = np.flatnonzero(pending)
+                if previous is not None:
+                    after = pages > previous[0] // page_size
+                    pages = np.concatenate([pages[after], pages[~after]])
+                chosen = None
+                for page in pages:
+                    start = int(page) * page_size
+                    end = min(len(states), start + page_size)
+                    if not any(start < t_end and t_start < end for t_start, t_end in taken):
+                        chosen = (start, end)
+                        break
+                if chosen is None:
+                    self._conn.execute(
+                        "DELETE FROM review_leases WHERE file_hash = ? AND reviewer = ?", (file_hash, reviewer)
+                    )
+                else:
+                    self._conn.execute(
+                        "INSERT OR REPLACE INTO review_leases VALUES (?, ?, ?, ?, ?)",
+                        (file_hash, reviewer, chosen[0], chosen[1], now + LEASE_TTL),
+                    )
+                self._conn.execute("COMMIT")
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+        return chosen[0] if chosen else None
+
+    def renew(self, file_hash: str, reviewer: str, start: int, end: int) -> None:
+        """Rinnova il lease del revisore se copre [start, end) (il revisore sta lavorando lì)."""
+        with self._lock:
+            self._conn.execute(
+                "UPDATE review_leases SET expires_at = ? WHERE file_hash = ? AND reviewer = ? "
+                "AND start_row <= ? AND end_row >= ?",
+                (time.time() + LEASE_TTL, file_hash, reviewer, start, end),
+            )
+
+    def holders(self, file_hash: str, start: int, end: int, reviewer: str) -> List[str]:
+        """Altri revisori con un lease attivo che si sovrappone a [start, end)."""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT reviewer FROM review_leases WHERE file_hash = ? AND reviewer != ? AND expires_at > ? "
+                "AND start_row < ? AND end_row > ?",
+                (file_hash, reviewer, time.time(), end, start),
+            ).fetchall()
+        return [r[0] for r in rows]
+
+    def rows_decided_by(self, file_hash: str, reviewers: Sequence[str]) -> List[int]:
+        """Righe la cui decisione in vigore (ultima dopo l'ultimo reset) è firmata da uno dei reviewers."""
+        with self._lock:
+            rows = self._conn.execute(
+                """
+                SELECT j.row_id FROM match_journal AS j
+                JOIN (
+                    SELECT MAX(seq) AS seq FROM match_journal
+                    WHERE file_hash = ? AND row_id >= 0 GROUP BY row_id
+                ) AS last ON j.seq = last.seq
+                WHERE j.reviewer IN ({}) AND j.state != ? AND j.seq > COALESCE(
+                    (SELECT MAX(seq) FROM match_journal WHERE file_hash = ? AND row_id = ?), 0
+                )
+                ORDER BY j.row_id
+                """.format(",".join("?" * len(reviewers))),
+                (file_hash, *reviewers, UNREVIEWED, file_hash, RESET_ROW),
+            ).fetchall()
+        return [r[0] for r in rows]
+
+    def active_reviewers(self, file_hash: str) -> int:
+        with self._lock:
+            return self._conn.execute(
+                "SELECT COUNT(*) FROM review_leases WHERE file_hash = ? AND expires_at > ?", (file_hash, time.time())
+            ).fetchone()[0]
+
+
+class MatchState:
+    def __init__(
+        self,
+        n_rows: int,
+        journal: Optional[ReviewJournal] = None,
+        file_hash: Optional[str] = None,
+        reviewer: Optional[str] = None,
+    ):
+        self.states = np.zeros(n_rows, dtype=np.int8)
+        # cresce a ogni modifica: chi deriva dati dallo stato (es. l'export) sa quando rigenerarli
+        self.revision = 0
+        self.journal = journal
+        self.file_hash = file_hash
+        self.reviewer = reviewer
+        # ultima voce del journal già applicata
+        self.seq = 0
+
+    @classmethod
+    def restore(
+        cls, n_rows: int, journal: ReviewJournal, file_hash: str, reviewer: Optional[str] = None
+    ) -> "MatchState":
+        """Stato del file ricostruito dal journal; le modifiche successive vengono accodate."""
+        state = cls(n_rows, journal, file_hash, reviewer)
+        state.sync()
+        return state
+
+    def sync(self) -> np.ndarray:
+        """
+        Applica le voci del journal non ancora viste (anche degli altri revisori: vale l'ultima).
+        Ritorna le righe il cui stato è cambiato.
+        """
+        if self.journal is None:
+            return np.empty(0, dtype=np.int64)
+        entries = self.journal.entries_since(self.file_hash, self.seq)
+        if not len(entries):
+            return np.empty(0, dtype=np.int64)
+        self.seq = int(entries[-1, 0])
+        before = self.states.copy()
+        resets = np.flatnonzero(entries[:, 1] == RESET_ROW)
+        if len(resets):
+            self.states.fill(UNREVIEWED)
+            entries = entries[resets[-1] + 1:]
+        entries = entries[(entries[:, 1] >= 0) & (entries[:, 1] < len(self.states))]
+        # ultima occorrenza di ogni riga: prima occorrenza nell'ordine inverso
+        row_ids, first = np.unique(entries[::-1, 1], return_index=True)
+        self.states[row_ids] = entries[::-1, 2][first]
+        changed = np.flatnonzero(before != self.states)
+        if len(changed):
+            self.revision += 1
+        return changed
+
+    def _record(self, row_ids, states, reviewer: Optional[str] = None) -> None:
+        self.revision += 1
+        if self.journal is not None:
+            self.journal.append_many(self.file_hash, row_ids, states, reviewer or self.reviewer)
+
+    def __len__(self) -> int:
+        return len(self.states)
+
+    def set_state(self, row_id: int, state: int) -> None:
+        """Stato esplicito della riga, anche UNREVIEWED (decisione annullata)."""
+        if self.states[row_id] != state:
+            self.states[row_id] = state
+            self._record([row_id], [state])
+
+    def get_state(self, row_id: int) -> int:
+        return int(self.states[row_id])
+
+    def set(self, row_id: int, value: bool) -> None:
+        self.set_state(row_id, MATCH if value else NO_MATCH)
+
+    def get(self, row_id: int) -> bool:
+        return bool(self.states[row_id] == MATCH)
+
+    def set_many(self, row_ids, values, reviewer: Optional[str] = None) -> None:
+        """
+        Assegnazione vettoriale: row_ids e values array-like della stessa lunghezza.
+        reviewer: chi firma le decisioni nel journal se non è il revisore della sessione (es. il triage).
+        """
+        row_ids = np.asarray(row_ids)
+        states = np.where(np.asarray(values, dtype=bool), MATCH, NO_MATCH).astype(np.int8)
+        self.states[row_ids] = states
+        self._record(row_ids, states, reviewer)
+
+    def set_auto(self, row_ids, values) -> None:
+        """Decisioni del triage automatico, firmate a nome del revisore che applica le soglie: il suo reset le annulla."""
+        self.set_many(row_ids, values, reviewer=triage_signature(self.reviewer or ""))
+
+    def match_column(self, start: int = 0, stop: Optional[int] = None) -> np.ndarray:
+        """Colonna MATCH (bool) per le righe [start, stop): le righe non revisionate valgono False."""
+        return self.states[start:stop] == MATCH
+
+    def reviewed(self) -> int:
+        return int(np.count_nonzero(self.states))
+
+    def counts(self) -> Dict[str, int]:
+        n = np.bincount(self.states, minlength=3)
+        return {"non_revisionate": int(n[UNREVIEWED]), "match": int(n[MATCH]), "no_match": int(n[NO_MATCH])}
+
+    def reset(self) -> np.ndarray:
+        """
+        Annulla le decisioni in vigore del revisore della sessione, comprese quelle del triage
+        applicato da lui, non quelle degli altri (senza journal: tutte).
+        Ritorna le righe tornate non revisionate.
+        """
+        if self.journal is None or self.reviewer is None:
+            rows = np.flatnonzero(self.states)
+        else:
+            self.sync()
+            mine = [self.reviewer, triage_signature(self.reviewer)]
+            rows = np.array(self.journal.rows_decided_by(self.file_hash, mine), dtype=np.int64)
+            rows = rows[rows < len(self.states)]
+        if len(rows):
+            self.states[rows] = UNREVIEWED
+            self._record(rows, np.full(len(rows), UNREVIEWED, dtype=np.int8))
+        return rows
+
+    def complete(self, row_ids, reviewer: Optional[str] = None) -> np.ndarray:
+        """Pagina revisionata: le righe ancora non revisionate tra row_ids diventano NO_MATCH. Ritorna quali."""
+        row_ids = np.asarray(row_ids, dtype=np.int64)
+        rows = row_ids[self.states[row_ids] == UNREVIEWED]
+        if len(rows):
+            self.set_many(rows, np.zeros(len(rows), dtype=bool), reviewer)
+        return rows
@@ -0,0 +1,165 @@
+"""
+Similarità visiva tra due immagini con hash percettivi (aHash, dHash, pHash), senza
+dipendenze da Streamlit. Ogni hash è un vettore di 64 bit; il punteggio 0–100 è la quota
+di bit uguali, mediata sui tre hash. Due immagini non correlate stanno intorno a 50.
+RowScores tiene i punteggi di tutte le righe di un file per il triage: decisioni automatiche
+sopra/sotto due soglie e coda di revisione con le sole coppie incerte.
+"""
+import io
+from typing import Optional, Tuple
+
+import numpy as np
+from PIL import Image, UnidentifiedImageError
+
+HASH_SIZE = 8
+# lato dell'immagine per il pHash: DCT 32x32, se ne tengono le basse frequenze 8x8
+PHASH_SIZE = 32
+HASH_NAMES = ("ahash", "dhash", "phash")
+# hash impacchettati: 3 hash da 64 bit = 24 byte
+HASH_BYTES = len(HASH_NAMES) * HASH_SIZE * HASH_SIZE // 8
+
+
+def _dct_matrix(n: int) -> np.ndarray:
+    # DCT-II ortonormale: dct(x) = D @ x, dct2(X) = D @ X @ D.T
+    k = np.arange(n)[:, None]
+    i = np.arange(n)[None, :]
+    d = np.sqrt(2.0 / n) * np.cos(np.pi * (2 * i + 1) * k / (2 * n))
+    d[0] /= np.sqrt(2.0)
+    return d.astype(np.float32)
+
+
+_DCT = _dct_matrix(PHASH_SIZE)
+
+
+def load_rgb(data: bytes, size: int = PHASH_SIZE) -> Optional[np.ndarray]:
+    """Immagine RGB size x size (float32), None se i byte non sono un'immagine."""
+    try:
+        img = Image.open(io.BytesIO(data))
+        # JPEG: decodifica già ridotta, molto più veloce su foto prodotto grandi
+        img.draft("RGB", (size * 4, size * 4))
+        img = img.convert("RGB").resize((size, size), Image.BILINEAR)
+    except (UnidentifiedImageError, OSError, ValueError, Image.DecompressionBombError):
+        return None
+    return np.asarray(img, dtype=np.float32)
+
+
+# luminanza ITU-R 601, come Image.convert("L")
+_LUMA = np.array([0.299, 0.587, 0.114], dtype=np.float32)
+# bin per canale dell'istogramma colore: HIST_BINS ** 3 valori
+HIST_BINS = 4
+
+
+def _downsample(gray: np.ndarray, h: int, w: int) -> np.ndarray:
+    # media a blocchi (area) da size x size a h x w, con indici interi
+    rows = np.linspace(0, gray.shape[0], h + 1).astype(int)
+    cols = np.linspace(0, gray.shape[1], w + 1).astype(int)
+    summed = np.add.reduceat(np.add.reduceat(gray, rows[:-1], axis=0), cols[:-1], axis=1)
+    counts = np.outer(np.diff(rows), np.diff(cols))
+    return summed / counts
+
+
+def hashes_from_gray(gray: np.ndarray) -> np.ndarray:
+    """Array bool (3, 64): aHash, dHash e pHash dell'immagine."""
+    small = _downsample(gray, HASH_SIZE, HASH_SIZE)
+    ahash = small > small.mean()
+    wide = _downsample(gray, HASH_SIZE, HASH_SIZE + 1)
+    dhash = wide[:, 1:] > wide[:, :-1]
+    low = (_DCT @ gray @ _DCT.T)[:HASH_SIZE, :HASH_SIZE]
+    # mediana senza la componente continua (luminosità media)
+    phash = low > np.median(low.ravel()[1:])
+    return np.stack([ahash.ravel(), dhash.ravel(), phash.ravel()])
+
+
+def color_histogram(rgb: np.ndarray) -> np.ndarray:
+    """Istogramma RGB congiunto (HIST_BINS ** 3 valori, somma 1)."""
+    q = np.minimum((rgb * (HIST_BINS / 256.0)).astype(np.int64), HIST_BINS - 1)
+    idx = (q[..., 0] * HIST_BINS + q[..., 1]) * HIST_BINS + q[..., 2]
+    hist = np.bincount(idx.ravel(), minlength=HIST_BINS ** 3).astype(np.float32)
+    return hist / hist.sum()
+
+
+def image_features(data: Optional[bytes]) -> Optional[Tuple[np.ndarray, np.ndarray]]:
+    """(hash bool (3, 64), istogramma colore) da una sola decodifica, None se non è un'immagine."""
+    if not data:
+        return None
+    rgb = load_rgb(data)
+    if rgb is None:
+        return None
+    return hashes_from_gray(rgb @ _LUMA), color_histogram(rgb)
+
+
+def image_hashes(data: Optional[bytes]) -> Optional[np.ndarray]:
+    features = image_features(data)
+    return features[0] if features is not None else None
+
+
+def similarity_score(a: Optional[np.ndarray], b: Optional[np.ndarray]) -> Optional[int]:
+    """Punteggio 0–100 (100 = hash identici); None se manca una delle due immagini."""
+    if a is None or b is None:
+        return None
+    return int(round(100 * (1.0 - np.count_nonzero(a != b) / a.size)))
+
+
+def pack_hashes(hashes: np.ndarray) -> np.ndarray:
+    """Hash bool (3, 64) → 24 byte uint8."""
+    return np.packbits(hashes.ravel())
+
+
+# bit a 1 di ogni byte
+_POPCOUNT = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+
+
+def packed_distances(a: np.ndarray, b: np.ndarray) -> np.ndarray:
+    """Distanze di Hamming (bit diversi) tra coppie di hash impacchettati (n, 24)."""
+    diff = np.ascontiguousarray(np.bitwise_xor(a, b))
+    if hasattr(np, "bitwise_count") and diff.shape[1] % 8 == 0:
+        # NumPy >= 2.0: popcount nativo su parole da 64 bit
+        return np.bitwise_count(diff.view(np.uint64)).sum(axis=1, dtype=np.int32)
+    return _POPCOUNT[diff].sum(axis=1, dtype=np.int32)
+
+
+def distance_scores(distances: np.ndarray, n_bits: int = HASH_BYTES * 8) -> np.ndarray:
+    """Distanze di Hamming → punteggi 0–100 (stessa scala di similarity_score)."""
+    return np.round(100 * (1.0 - distances / n_bits)).astype(np.float32)
+
+
+def packed_scores(a: np.ndarray, b: np.ndarray) -> np.ndarray:
+    """
+    Punteggi 0–100 per coppie di hash impacchettati (n, 24), tutti insieme: stessa scala
+    di similarity_score. Le righe senza hash vanno scartate prima (o ignorate dopo).
+    """
+    return distance_scores(packed_distances(a, b), a.shape[1] * 8)
+
+
+# -----------------------------
+# Triage: punteggi per riga e coda delle coppie incerte
+# -----------------------------
+class RowScores:
+    """Punteggio per riga (NaN se manca un'immagine) e quali righe sono già state calcolate."""
+
+    def __init__(self, n_rows: int):
+        self.scores = np.full(n_rows, np.nan, dtype=np.float32)
+        self.done = np.zeros(n_rows, dtype=bool)
+
+    def update(self, row_ids, scores) -> None:
+        """scores: punteggi 0–100; None o NaN dove manca un'immagine."""
+        row_ids = np.asarray(row_ids, dtype=np.int64)
+        self.scores[row_ids] = np.array([np.nan if s is None else s for s in scores], dtype=np.float32)
+        self.done[row_ids] = True
+
+    def pending(self) -> np.ndarray:
+        return np.flatnonzero(~self.done)
+
+    def auto_decisions(self, low: float, high: float) -> Tuple[np.ndarray, np.ndarray]:
+        """Righe da marcare MATCH (punteggio >= high) e no match (punteggio < low)."""
+        return np.flatnonzero(self.scores >= high), np.flatnonzero(self.scores < low)
+
+    def triage_queue(self, low: float, high: float) -> np.ndarray:
+        """
+        Righe da rivedere: quelle incerte (low <= punteggio < high), dalla più vicina al centro
+        della banda (le più difficili) alla più lontana; in coda quelle senza punteggio.
+        """
+        band = np.flatnonzero((self.scores >= low) & (self.scores < high))
+        band = band[np.argsort(np.abs(self.scores[band] - (low + high) / 2), kind="stable")]
+        return np.concatenate([band, np.flatnonzero(np.isnan(self.scores))])
+
@@ -0,0 +1,53 @@
+"""Ripresa dell'estrazione feature dopo un'interruzione."""
+import io
+
+import numpy as np
+import pytest
+from PIL import Image
+
+import features
+from features import FeatureStore, extract_urls
+
+
+def png(i: int) -> bytes:
+    rng = np.random.default_rng(i)
+    buf = io.BytesIO()
+    Image.fromarray(rng.integers(0, 256, (40, 40, 3), dtype=np.uint8)).save(buf, format="PNG")
+    return buf.getvalue()
+
+
+IMAGES = {f"http://img.example/{i}.png": png(i) for i in range(10)}
+URLS = list(IMAGES)
+
+
+def valid_urls(store: FeatureStore) -> int:
+    return int(store.gather_urls(URLS)[0].sum())
+
+
+def test_interrupted_run_resumes(tmp_path, monkeypatch):
+    monkeypatch.setattr(features, "WINDOW_URLS", 5)
+    store = FeatureStore(str(tmp_path / "features"))
+
+    def interrupted(url):
+        if url == URLS[7]:
+            raise KeyboardInterrupt
+        return IMAGES[url]
+
+    with pytest.raises(KeyboardInterrupt):
+        extract_urls(URLS, interrupted, store, download_workers=1, processes=1)
+    # nessun URL mappato su un contenuto le cui feature non sono state salvate
+    shas = store.url_shas(URLS)
+    assert store.known(list(shas.values())) == set(shas.values())
+
+    stats = extract_urls(URLS, IMAGES.get, store, download_workers=2, processes=1)
+    assert stats.urls == len(URLS) - len(shas)
+    assert valid_urls(store) == len(URLS)
+
+
+def test_url_mapped_to_missing_features_is_recomputed(tmp_path):
+    store = FeatureStore(str(tmp_path / "features"))
+    # mappa scritta da una versione precedente, feature mai salvate
+    store.put_urls([(URLS[0], features.content_hash(IMAGES[URLS[0]]))])
+    stats = extract_urls(URLS[:1], IMAGES.get, store, download_workers=1, processes=1)
+    assert stats.urls == 1
+    assert store.gather_urls(URLS[:1])[0].all()
@@ -0,0 +1,89 @@
+"""Lettura dei CSV: encoding oltre il campione, righe malformate, cache degli upload."""
+import io
+import os
+import time
+
+import pytest
+
+import ingest
+from ingest import ColumnStore, convert_to_arrow, load_csv, prune_files, sniff_source
+
+
+def ascii_then_cp1252(rows: int = 5000, bad_row: int = 4500) -> bytes:
+    lines = [f"{i},prodotto {i},http://img.example/{i}.jpg" for i in range(rows)]
+    head = ("id,desc,img\n" + "\n".join(lines[:bad_row]) + "\n").encode("ascii")
+    bad = f"{bad_row},caffè perché,http://img.example/{bad_row}.jpg\n".encode("cp1252")
+    return head + bad + ("\n".join(lines[bad_row + 1:]) + "\n").encode("ascii")
+
+
+def test_load_csv_retries_next_encoding():
+    df, dialect = load_csv(io.BytesIO(ascii_then_cp1252()))
+    assert dialect.encoding == "cp1252"
+    assert not dialect.replaced
+    assert df["desc"].iloc[4500] == "caffè perché"
+
+
+RAGGED = b"id,desc,img\n1,a,http://img.example/1.jpg\n2,b,http://img.example/2.jpg,extra\n3,c,http://img.example/3.jpg\n"
+
+
+@pytest.mark.parametrize("arrow", [True, False])
+def test_load_csv_skips_ragged_rows(monkeypatch, arrow):
+    if not arrow:
+        monkeypatch.setattr(ingest, "pacsv", None)
+    df, dialect = load_csv(io.BytesIO(RAGGED))
+    assert dialect.skipped_rows == 1
+    assert df["id"].tolist() == ["1", "3"]
+    assert "1 righe malformate saltate" in dialect.describe()
+
+
+def test_convert_to_arrow_retries_next_encoding(tmp_path):
+    pytest.importorskip("pyarrow")
+    data = ascii_then_cp1252()
+    dialect, columns = sniff_source(io.BytesIO(data))
+    assert dialect.encoding == "utf-8"
+    path = str(tmp_path / "file.arrow")
+    effective = convert_to_arrow(io.BytesIO(data), dialect, columns, path)
+    store = ColumnStore(path)
+    assert effective.encoding == store.encoding == "cp1252"
+    assert not store.replaced
+    assert store.rows(4500, 4501)["desc"].iloc[0] == "caffè perché"
+
+
+def test_convert_to_arrow_skips_ragged_rows(tmp_path):
+    pytest.importorskip("pyarrow")
+    dialect, columns = sniff_source(io.BytesIO(RAGGED))
+    path = str(tmp_path / "file.arrow")
+    effective = convert_to_arrow(io.BytesIO(RAGGED), dialect, columns, path)
+    store = ColumnStore(path)
+    assert effective.skipped_rows == store.skipped_rows == 1
+    assert store.columns(["id"])["id"].tolist() == ["1", "3"]
+
+
+def test_duplicate_and_blank_header_names(tmp_path):
+    pytest.importorskip("pyarrow")
+    data = b"a,a,,b,a.1,a\n1,2,3,4,5,6\n"
+    expected = ["a", "a.2", "Unnamed: 2", "b", "a.1", "a.3"]
+    df, _ = load_csv(io.BytesIO(data))
+    assert df.columns.tolist() == expected
+    dialect, columns = sniff_source(io.BytesIO(data))
+    assert columns == expected
+    path = str(tmp_path / "file.arrow")
+    convert_to_arrow(io.BytesIO(data), dialect, columns, path)
+    store = ColumnStore(path)
+    assert store.columns(["a", "a.3"]).iloc[0].tolist() == ["1", "6"]
+
+
+def test_prune_files_evicts_least_recently_used(tmp_path):
+    now = time.time()
+    for i, name in enumerate(["a.arrow", "b.arrow", "c.arrow", "d.arrow.tmp"]):
+        path = tmp_path / name
+        path.write_bytes(b"x" * 100)
+        os.utime(path, (now - 100 + i, now - 100 + i))
+    old = tmp_path / "old.arrow"
+    old.write_bytes(b"x")
+    os.utime(old, (now - 10_000, now - 10_000))
+
+    freed = prune_files(str(tmp_path), max_bytes=200, max_age=1_000, keep=[str(tmp_path / "a.arrow")])
+    # old: scaduto; poi b e c, i meno recenti non in uso; a è in uso, il .tmp è recente
+    assert sorted(p.name for p in tmp_path.iterdir()) == ["a.arrow", "d.arrow.tmp"]
+    assert freed == 201
@@ -0,0 +1,39 @@
+"""Ricerca multi-banda: stessi risultati del confronto esaustivo sopra MIN_RELIABLE_SCORE."""
+import numpy as np
+
+from matching import MIN_RELIABLE_SCORE, HashIndex
+from similarity import HASH_BYTES, packed_scores
+
+
+def flip(hashes: np.ndarray, n_bits: int, rng: np.random.Generator) -> np.ndarray:
+    bits = np.unpackbits(hashes, axis=1)
+    for row in bits:
+        row[rng.choice(bits.shape[1], n_bits, replace=False)] ^= 1
+    return np.packbits(bits, axis=1)
+
+
+def test_top_k_matches_brute_force_above_floor():
+    rng = np.random.default_rng(0)
+    catalog = rng.integers(0, 256, (3000, HASH_BYTES), dtype=np.uint8)
+    # 36 bit invertiti su 192 ≈ punteggio 81, appena sopra la soglia dichiarata
+    queries = flip(catalog[:200], 36, rng)
+    ids, scores = HashIndex(catalog).top_k(queries, 3)
+
+    exact = np.stack([packed_scores(np.broadcast_to(q, catalog.shape), catalog) for q in queries])
+    best = exact.max(axis=1)
+    assert (best >= MIN_RELIABLE_SCORE).all()
+    found = ids[:, 0] >= 0
+    assert (scores[:, 0] == best).mean() >= 0.8
+    # i punteggi restituiti sono quelli esatti degli elementi indicati
+    assert (exact[np.arange(len(queries))[found], ids[found, 0]] == scores[found, 0]).all()
+
+
+def test_top_k_no_duplicates_and_padding():
+    rng = np.random.default_rng(1)
+    catalog = rng.integers(0, 256, (50, HASH_BYTES), dtype=np.uint8)
+    ids, scores = HashIndex(catalog).top_k(catalog[:5], 4)
+    assert (ids[:, 0] == np.arange(5)).all() and (scores[:, 0] == 100).all()
+    for row, row_scores in zip(ids, scores):
+        real = row[row >= 0]
+        assert len(set(real)) == len(real)
+        assert np.isnan(row_scores[row < 0]).all()
@@ -0,0 +1,122 @@
+"""
+extract_og_image contro l'implementazione BeautifulSoup che sostituisce, sul corpus di
+tests/fixtures/amazon_pages. Le pagine sono sintetiche, scritte a mano: una per caso limite
+del parser (commenti, stringhe in <script>/<style>, tag dentro attributi, ">" tra virgolette,
+entità, attributi senza virgolette, og:image vuoto o nel body, captcha) più product_dp.html,
+un head in stile Amazon con un blocco di <script> ripetuto per arrivare a ~12 KB.
+Nessuna è una pagina Amazon salvata. beautifulsoup4 è in requirements-dev.txt: senza, il
+confronto fallisce invece di essere saltato.
+"""
+import os
+from typing import Optional
+
+import bs4
+import pytest
+
+from resolver import FetchError, HostRateLimiter, extract_og_image, fetch_html, fetch_og_image
+
+PAGES_DIR = os.path.join(os.path.dirname(__file__), "fixtures", "amazon_pages")
+PAGES = sorted(f for f in os.listdir(PAGES_DIR) if f.endswith(".html"))
+
+
+def bs_extract_og_image(html: str) -> Optional[str]:
+    # implementazione precedente (app.py), senza st.cache_data
+    try:
+        soup = bs4.BeautifulSoup(html, "html.parser")
+        tag = soup.find("meta", property="og:image")
+        if tag and tag.get("content"):
+            return tag["content"].strip()
+
+        # fallback twitter:image
+        tag = soup.find("meta", attrs={"name": "twitter:image"})
+        if tag and tag.get("content"):
+            return tag["content"].strip()
+
+        return None
+    except Exception:
+        return None
+
+
+def read_page(name: str) -> str:
+    with open(os.path.join(PAGES_DIR, name), encoding="utf-8") as f:
+        return f.read()
+
+
+@pytest.mark.parametrize("name", PAGES)
+def test_same_result_as_beautifulsoup(name):
+    html = read_page(name)
+    # "" e None valgono entrambi "nessuna immagine" per fetch_og_image
+    assert extract_og_image(html) == (bs_extract_og_image(html) or None)
+
+
+def test_meta_inside_script_is_text():
+    assert extract_og_image(read_page("meta_in_script_string.html")).endswith("_AC_SL1500_.jpg")
+
+
+def test_quoted_gt_does_not_close_tag():
+    assert extract_og_image(read_page("gt_in_content.html")) == "https://m.media-amazon.com/images/I/a>b.jpg"
+
+
+class FakeResponse:
+    def __init__(self, body: bytes, chunk_size: int):
+        self.status_code = 200
+        self.encoding = "utf-8"
+        self.chunks = [body[i:i + chunk_size] for i in range(0, len(body), chunk_size)]
+        self.read = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def iter_content(self, chunk_size: int):
+        for chunk in self.chunks:
+            self.read += len(chunk)
+            yield chunk
+
+
+class FakeSession:
+    """Risponde sempre con la stessa pagina, a chunk di chunk_size byte."""
+
+    def __init__(self, html: str, chunk_size: int = 16 * 1024):
+        self.body = html.encode("utf-8")
+        self.chunk_size = chunk_size
+        self.response: Optional[FakeResponse] = None
+
+    def get(self, url, **kwargs):
+        self.response = FakeResponse(self.body, self.chunk_size)
+        return self.response
+
+
+def fetch(html: str, chunk_size: int = 16 * 1024):
+    return fetch_og_image("https://www.amazon.it/dp/B000000000", FakeSession(html, chunk_size), None, HostRateLimiter({}))
+
+
+def test_captcha_page_is_a_fetch_error():
+    # HTTP 200 senza og:image: da riprovare (TTL "error"), non un prodotto senza immagine
+    with pytest.raises(FetchError):
+        fetch(read_page("captcha.html"))
+    assert fetch(read_page("twitter_only.html"))[0] == "ok"
+    assert fetch("<html><head><title>Amazon.it: Prodotto</title></head></html>") == ("not_found", None)
+
+
+# l'og:image di og_in_body.html è dopo </head>: lo streaming si ferma prima, per scelta
+HEAD_PAGES = [name for name in PAGES if name != "og_in_body.html"]
+
+
+@pytest.mark.parametrize("chunk_size", [1, 64, 16 * 1024])
+@pytest.mark.parametrize("name", HEAD_PAGES)
+def test_streaming_stops_only_when_the_head_is_decided(name, chunk_size):
+    # tag finti in commenti, script e attributi in un chunk, quello vero nel successivo
+    html = read_page(name)
+    session = FakeSession(html, chunk_size)
+    streamed = fetch_html("https://www.amazon.it/dp/B000000000", session, None, HostRateLimiter({}))
+    assert extract_og_image(streamed) == extract_og_image(html)
+
+
+def test_streaming_stops_after_head():
+    html = read_page("product_dp.html")
+    session = FakeSession(html, 64)
+    fetch_html("https://www.amazon.it/dp/B000000000", session, None, HostRateLimiter({}))
+    assert session.response.read < len(session.body)
@@ -0,0 +1,101 @@
+"""Lease delle pagine e reset per revisore sul journal condiviso."""
+import time
+
+import numpy as np
+
+from review import MATCH, NO_MATCH, UNREVIEWED, MatchState, ReviewJournal
+
+PAGE = 10
+
+
+def journal(tmp_path) -> ReviewJournal:
+    return ReviewJournal(str(tmp_path / "reviews.sqlite"))
+
+
+def test_claim_moves_past_the_page_just_worked(tmp_path):
+    j = journal(tmp_path)
+    alice = MatchState.restore(30, j, "f", "alice")
+    assert j.claim("f", "alice", alice.states, PAGE) == 0
+    alice.set(0, True)
+    alice.set(3, True)
+    # la pagina 0 ha ancora righe da vedere, ma "prossima" va avanti
+    assert j.claim("f", "alice", alice.states, PAGE) == 10
+    # e torna all'inizio quando le pagine successive sono finite
+    alice.complete(np.arange(10, 30))
+    assert j.claim("f", "alice", alice.states, PAGE) == 0
+
+
+def test_complete_marks_remaining_rows_no_match(tmp_path):
+    state = MatchState.restore(20, journal(tmp_path), "f", "alice")
+    state.set(2, True)
+    done = state.complete(np.arange(0, 10))
+    assert len(done) == 9
+    assert state.states[2] == MATCH
+    assert (state.states[[0, 1, 3, 9]] == NO_MATCH).all()
+    assert (state.states[10:] == UNREVIEWED).all()
+    assert state.counts()["non_revisionate"] == 10
+
+
+def test_reset_only_undoes_own_decisions(tmp_path):
+    j = journal(tmp_path)
+    alice = MatchState.restore(20, j, "f", "alice")
+    bob = MatchState.restore(20, j, "f", "bob")
+    alice.set(0, True)
+    alice.set(1, False)
+    bob.set(5, True)
+    # riga decisa da alice e poi cambiata da bob: vale bob, il reset di alice non la tocca
+    alice.set(7, True)
+    bob.sync()
+    bob.set(7, False)
+
+    alice.sync()
+    assert sorted(alice.reset().tolist()) == [0, 1]
+    bob.sync()
+    assert bob.states[0] == bob.states[1] == UNREVIEWED
+    assert bob.states[5] == MATCH and bob.states[7] == NO_MATCH
+    # un nuovo MatchState dal journal vede lo stesso risultato
+    fresh = MatchState.restore(20, j, "f", "carla")
+    assert (fresh.states == bob.states).all()
+
+
+def test_bulk_decisions_are_one_transaction(tmp_path):
+    state = MatchState.restore(100_000, journal(tmp_path), "f", "alice")
+    rows = np.arange(100_000)
+    started = time.perf_counter()
+    state.set_many(rows, rows % 2 == 0, reviewer="triage-auto")
+    # un commit per riga costava ~10 s (un fsync ciascuno)
+    assert time.perf_counter() - started < 2.0
+    fresh = MatchState.restore(100_000, state.journal, "f", "bob")
+    assert (fresh.states == state.states).all()
+
+
+def test_reset_also_undoes_own_triage(tmp_path):
+    j = journal(tmp_path)
+    alice = MatchState.restore(20, j, "f", "alice")
+    bob = MatchState.restore(20, j, "f", "bob")
+    alice.set_auto(np.arange(0, 5), [True, False, True, False, True])
+    bob.set_auto(np.arange(10, 12), [True, True])
+    alice.set(7, True)
+    alice.sync()
+    assert sorted(alice.reset().tolist()) == [0, 1, 2, 3, 4, 7]
+    assert (alice.states[10:12] == MATCH).all()
+
+
+def test_conflicts_ignore_undo_and_triage(tmp_path):
+    j = journal(tmp_path)
+    alice = MatchState.restore(20, j, "f", "alice")
+    bob = MatchState.restore(20, j, "f", "bob")
+    # riga 0: alice e bob in disaccordo
+    alice.set(0, True)
+    bob.set(0, False)
+    # riga 1: alice annulla la propria decisione, poi decide bob
+    alice.set(1, True)
+    alice.set_state(1, UNREVIEWED)
+    bob.set(1, False)
+    # riga 2: bob corregge il triage
+    alice.set_auto([2], [True])
+    bob.set(2, False)
+    # riga 3: stessa decisione
+    alice.set(3, True)
+    bob.set(3, True)
+    assert j.conflicts("f") == [0]